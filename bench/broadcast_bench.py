@@ -0,0 +1,264 @@
+"""Бенчмарк рассылок на локальной заглушке Bot API.
+
+Поднимает aiohttp-сервер вместо api.telegram.org (задержка, 429 и
+"bot was blocked" настраиваются), заполняет временную SQLite базу
+синтетическими пользователями и прогоняет через неё обработчики
+segmentsendall и get_custom_message. В конце печатает скорость,
+задержки отправки и число записей в БД.
+
+    python bench/broadcast_bench.py --users 10000
+    python bench/broadcast_bench.py --users 100000 --rate 28 --p429 0.001 --blocked 0.1
+    python bench/broadcast_bench.py --users 2000 --rate 60 --limit 30
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bot')
+ADMIN_ID = 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--mode', choices=['product', 'custom', 'both'], default='both')
+    parser.add_argument('--latency-ms', type=float, default=30, help='средняя задержка ответа заглушки')
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--p429', type=float, default=0.0, help='доля ответов 429 Too Many Requests')
+    parser.add_argument('--limit', type=float, default=0,
+                        help='лимит заглушки, сообщ./с: сверх него отвечает 429 (0 — без лимита)')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--blocked', type=float, default=0.05, help='доля пользователей, заблокировавших бота')
+    parser.add_argument('--rate', type=float, default=1000, help='BROADCAST_RATE; 28 — реальный лимит Telegram')
+    parser.add_argument('--workers', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# Настройки бота читаются из окружения при импорте модулей, поэтому задаем их заранее
+workdir = tempfile.mkdtemp(prefix='broadcast_bench_')
+os.environ['DATABASE_URL'] = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.sqlite3')}"
+os.environ['BROADCAST_RATE'] = str(args.rate)
+os.environ['BROADCAST_WORKERS'] = str(args.workers)
+os.environ.setdefault('ADMIN_ID', str(ADMIN_ID))
+os.environ.setdefault('ADMIN_ID2', str(ADMIN_ID))
+sys.path.insert(0, os.path.abspath(BOT_DIR))
+os.chdir(workdir)
+
+from aiohttp import web  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.fsm.context import FSMContext  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+from aiogram.types import CallbackQuery, Message  # noqa: E402
+from sqlalchemy import event, insert  # noqa: E402
+
+from database.models import async_main, async_session, engine, User, Kurs  # noqa: E402
+import utils.broadcast as broadcast  # noqa: E402
+from utils.flood_control import flood_control  # noqa: E402
+from admin.sendall import segmentsendall  # noqa: E402
+from keyboards.keyboard import SegmentChoice  # noqa: E402
+from admin.custom_sendall import get_custom_message, Custom_message  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+SEND_METHODS = {'senddocument', 'sendphoto', 'copymessage', 'copymessages'}
+
+
+class FakeTelegram:
+    """Заглушка Bot API: отвечает на любые методы с задержкой и ошибками по настройкам"""
+
+    def __init__(self):
+        self.rng = random.Random(args.seed)
+        self.calls = 0
+        self.flood = 0
+        self.blocked = 0
+        self._window = collections.deque()
+
+    def over_limit(self) -> bool:
+        if not args.limit:
+            return False
+        now = time.monotonic()
+        while self._window and now - self._window[0] > 1:
+            self._window.popleft()
+        if len(self._window) >= args.limit:
+            return True
+        self._window.append(now)
+        return False
+
+    def is_blocked(self, chat_id: int) -> bool:
+        return chat_id != ADMIN_ID and random.Random(chat_id * 7919 + args.seed).random() < args.blocked
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        params = dict(await request.post())
+        chat_id = int(params.get('chat_id', ADMIN_ID))
+        self.calls += 1
+        await asyncio.sleep(max(0.0, self.rng.gauss(args.latency_ms, args.jitter_ms)) / 1000)
+
+        if method in SEND_METHODS:
+            if self.over_limit() or self.rng.random() < args.p429:
+                self.flood += 1
+                return web.json_response({'ok': False, 'error_code': 429,
+                                          'description': f'Too Many Requests: retry after {args.retry_after}',
+                                          'parameters': {'retry_after': args.retry_after}}, status=429)
+            if self.is_blocked(chat_id):
+                self.blocked += 1
+                return web.json_response({'ok': False, 'error_code': 403,
+                                          'description': 'Forbidden: bot was blocked by the user'}, status=403)
+
+        message = {'message_id': self.calls, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        if method == 'copymessage':
+            result = {'message_id': self.calls}
+        elif method == 'copymessages':
+            result = [{'message_id': self.calls + i} for i in range(len(json.loads(params['message_ids'])))]
+        elif method in ('answercallbackquery', 'deletewebhook', 'setwebhook'):
+            result = True
+        else:
+            result = message
+        return web.json_response({'ok': True, 'result': result})
+
+
+class LatencyRecorder:
+    """Middleware сессии: время ответа на запросы отправки сообщений"""
+
+    def __init__(self):
+        self.samples = []
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            if type(method).__name__.lower() in SEND_METHODS:
+                self.samples.append(time.perf_counter() - started)
+
+
+class WriteCounter:
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.commits = 0
+
+    def reset(self):
+        self.statements = self.rows = self.commits = 0
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE')):
+            self.statements += 1
+            self.rows += len(parameters) if executemany else 1
+
+    def on_commit(self, conn):
+        self.commits += 1
+
+
+async def seed_db():
+    await async_main()
+    async with async_session() as session:
+        batch = 5000
+        for start in range(0, args.users, batch):
+            rows = [{'tg_id': 10_000_000 + i, 'tg_name': f'user{i}', 'active': 1}
+                    for i in range(start, min(start + batch, args.users))]
+            await session.execute(insert(User), rows)
+        session.add(Kurs(name_fail_kurs='bench', photo_kurs='photo-id', description_kurs='Курс для бенчмарка',
+                         fail_kurs='file-id', local_path_kurs='', price_star_kurs=1))
+        await session.commit()
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def wait_broadcasts():
+    while broadcast._running:
+        await asyncio.gather(*list(broadcast._running))
+
+
+async def run_case(name, bot, trigger, fake, latency, writes):
+    latency.samples.clear()
+    writes.reset()
+    calls_before, flood_before, blocked_before = fake.calls, fake.flood, fake.blocked
+    started = time.perf_counter()
+    await trigger()
+    await wait_broadcasts()
+    elapsed = time.perf_counter() - started
+    sent = len(latency.samples)
+    print(f'\n== {name}: {args.users} пользователей')
+    print(f'  время:              {elapsed:.1f} с')
+    print(f'  запросов отправки:  {sent} ({sent / elapsed:.1f} сообщ./с)')
+    print(f'  задержка p50/p99:   {percentile(latency.samples, 0.5) * 1000:.1f} / '
+          f'{percentile(latency.samples, 0.99) * 1000:.1f} мс')
+    print(f'  всего вызовов API:  {fake.calls - calls_before}, 429: {fake.flood - flood_before}, '
+          f'blocked: {fake.blocked - blocked_before}')
+    print(f'  записи в БД:        {writes.statements} запросов, {writes.rows} строк, {writes.commits} коммитов')
+    print(f'  flood control:      {flood_control.stats()}')
+
+
+async def main():
+    fake = FakeTelegram()
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', fake.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f'http://127.0.0.1:{port}'))
+    bot = Bot(token='42:BENCH', session=session)
+    latency = LatencyRecorder()
+    bot.session.middleware(latency)
+    bot.session.middleware(flood_control)
+
+    writes = WriteCounter()
+    await seed_db()
+    event.listen(engine.sync_engine, 'before_cursor_execute', writes.on_execute)
+    event.listen(engine.sync_engine, 'commit', writes.on_commit)
+
+    chat = {'id': ADMIN_ID, 'type': 'private'}
+    admin = {'id': ADMIN_ID, 'is_bot': False, 'first_name': 'admin'}
+
+    async def product():
+        callback_data = SegmentChoice(data_type='kurs', product_id=1, code='all')
+        callback = CallbackQuery.model_validate({
+            'id': '1', 'from': admin, 'chat_instance': '1', 'data': callback_data.pack(),
+            'message': {'message_id': 1, 'date': 0, 'chat': chat, 'text': 'menu'},
+        }, context={'bot': bot})
+        await segmentsendall(callback, callback_data, bot)
+
+    async def custom():
+        message = Message.model_validate({'message_id': 2, 'date': 0, 'chat': chat, 'from': admin,
+                                          'text': '<b>Новости</b>'}, context={'bot': bot})
+        state = FSMContext(storage=MemoryStorage(), key=StorageKey(bot_id=bot.id, chat_id=ADMIN_ID, user_id=ADMIN_ID))
+        await state.set_state(Custom_message.msg_custom)
+        await get_custom_message(message, state, bot)
+
+    try:
+        if args.mode in ('product', 'both'):
+            await run_case('segmentsendall (product)', bot, product, fake, latency, writes)
+        if args.mode in ('custom', 'both'):
+            async with engine.begin() as conn:
+                await conn.exec_driver_sql('UPDATE users SET active = 1')
+            await run_case('get_custom_message (copy_message)', bot, custom, fake, latency, writes)
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
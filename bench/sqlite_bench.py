@@ -0,0 +1,154 @@
+"""Бенчмарк чтения каталога во время записей рассылки.
+
+Заполняет временную SQLite базу пользователями и товарами, затем
+параллельно гоняет писателей (set_active_many, add_product_views, set_user —
+как во время рассылки) и читателей каталога (страницы get_products_page
+и перезагрузка кэша catalog после изменения товаров) и
+печатает задержки чтения. Профиль соединения задается SQLITE_PROFILE из
+database/models.py, --profile both прогоняет оба профиля подряд.
+
+    python bench/sqlite_bench.py
+    python bench/sqlite_bench.py --profile default --duration 20 --writers 4
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bot')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profile', choices=['tuned', 'default', 'both'], default='both')
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--products', type=int, default=30)
+    parser.add_argument('--duration', type=float, default=10, help='длительность прогона, с')
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--batch', type=int, default=500, help='размер пачки set_active_many')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+
+args = parse_args()
+
+if args.profile == 'both':
+    # Движок создается при импорте models, поэтому каждый профиль — отдельный процесс
+    options = [f'--{name}={value}' for name, value in vars(args).items() if name != 'profile']
+    for profile in ('default', 'tuned'):
+        subprocess.run([sys.executable, os.path.abspath(__file__), f'--profile={profile}', *options], check=True)
+    sys.exit(0)
+
+workdir = tempfile.mkdtemp(prefix='sqlite_bench_')
+os.environ['DATABASE_URL'] = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.sqlite3')}"
+os.environ['SQLITE_PROFILE'] = args.profile
+sys.path.insert(0, os.path.abspath(BOT_DIR))
+os.chdir(workdir)
+
+import logging  # noqa: E402
+
+from sqlalchemy import insert  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+from database.models import async_main, async_session, engine, sqlite_pragmas, User, Gaid, Kurs  # noqa: E402
+import database.requests as rq  # noqa: E402
+from database.catalog import catalog  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+async def seed_db():
+    await async_main()
+    async with async_session() as session:
+        for start in range(0, args.users, 5000):
+            rows = [{'tg_id': 10_000_000 + i, 'tg_name': f'user{i}', 'active': 1}
+                    for i in range(start, min(start + 5000, args.users))]
+            await session.execute(insert(User), rows)
+        for i in range(args.products):
+            session.add(Gaid(name_fail_gaid=f'gaid{i}', photo_gaid='photo-id', description_gaid='Гайд',
+                             fail_gaid='file-id', local_path_gaid='', price_star_gaid=1))
+            session.add(Kurs(name_fail_kurs=f'kurs{i}', photo_kurs='photo-id', description_kurs='Курс',
+                             fail_kurs='file-id', local_path_kurs='', price_star_kurs=1))
+        await session.commit()
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Counters:
+    def __init__(self):
+        self.reads = []
+        self.writes = 0
+        self.locked = 0
+
+
+async def writer(n, deadline, counters):
+    rng = random.Random(args.seed + n)
+    next_tg_id = 20_000_000 + n * 1_000_000
+    while time.monotonic() < deadline:
+        try:
+            op = rng.random()
+            if op < 0.4:
+                batch = [(10_000_000 + rng.randrange(args.users), rng.randint(0, 1)) for _ in range(args.batch)]
+                await rq.set_active_many(batch)
+            elif op < 0.8:
+                await rq.add_product_views([{'user_tg_id': 10_000_000 + rng.randrange(args.users), 'product_type': 'gaid',
+                                             'product_id': rng.randrange(args.products) + 1}])
+            else:
+                next_tg_id += 1
+                await rq.set_user(next_tg_id, f'new{next_tg_id}')
+            counters.writes += 1
+        except OperationalError:
+            counters.locked += 1
+
+
+async def reader(n, deadline, counters):
+    rng = random.Random(args.seed * 31 + n)
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            op = rng.random()
+            if op < 0.8:
+                data_type = 'gaid' if op < 0.4 else 'kurs'
+                await rq.get_products_page(data_type, rng.randrange(args.products + 1), rng.choice(['next', 'prev']))
+            else:
+                catalog.invalidate()
+                await catalog.all('kurs')
+        except OperationalError:
+            counters.locked += 1
+            continue
+        counters.reads.append(time.perf_counter() - started)
+
+
+async def main():
+    await seed_db()
+    counters = Counters()
+    deadline = time.monotonic() + args.duration
+    started = time.perf_counter()
+    await asyncio.gather(*[writer(i, deadline, counters) for i in range(args.writers)],
+                         *[reader(i, deadline, counters) for i in range(args.readers)])
+    elapsed = time.perf_counter() - started
+    await engine.dispose()
+
+    reads = counters.reads
+    print(f'\n== профиль {args.profile}: {sqlite_pragmas() or "PRAGMA по умолчанию"}')
+    print(f'  пул:                 size={engine.pool.size()}, writers={args.writers}, readers={args.readers}')
+    print(f'  чтений:              {len(reads)} ({len(reads) / elapsed:.0f} /с)')
+    print(f'  записей:             {counters.writes} ({counters.writes / elapsed:.0f} /с)')
+    print(f'  задержка чтения p50/p95/p99/max: '
+          f'{percentile(reads, 0.5) * 1000:.1f} / {percentile(reads, 0.95) * 1000:.1f} / '
+          f'{percentile(reads, 0.99) * 1000:.1f} / {max(reads, default=0) * 1000:.1f} мс')
+    print(f'  database is locked:  {counters.locked}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
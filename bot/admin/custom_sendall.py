@@ -1,17 +1,70 @@
+import asyncio
+
 from aiogram import F, Router, Bot
 from aiogram.types import CallbackQuery, Message
 from dotenv import load_dotenv
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from aiogram.exceptions import TelegramBadRequest
 
-import database.requests as rq
+from utils.broadcast import job_kind, start_broadcast
 
 router = Router()
 
 load_dotenv()
 
 
+# Сколько ждать остальные части альбома после первой, секунд
+ALBUM_WAIT = 1.0
+
+_album_tasks: set[asyncio.Task] = set()
+
+
+class AlbumCollector:
+    """Части альбомов, которые еще собираются, по media_group_id.
+
+    Части одного альбома приходят отдельными апдейтами, а за nginx — на разные
+    реплики. После share(redis) части копятся в общем списке Redis: RPUSH
+    атомарно возвращает длину, и только реплика, получившая первую часть,
+    запускает рассылку.
+    """
+
+    def __init__(self, ttl: int = 60):
+        self.ttl = ttl
+        self._albums: dict[str, list[int]] = {}
+        self.redis = None
+
+    def share(self, redis):
+        """Собирать альбомы в Redis, общем для всех реплик бота"""
+        self.redis = redis
+
+    async def add(self, media_group_id: str, message_id: int) -> bool:
+        """Добавляет часть альбома; True для первой части"""
+        if self.redis is None:
+            album = self._albums.setdefault(media_group_id, [])
+            album.append(message_id)
+            return len(album) == 1
+        key = f'album:{media_group_id}'
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, message_id)
+            pipe.expire(key, self.ttl)
+            length, _ = await pipe.execute()
+        return length == 1
+
+    async def take(self, media_group_id: str) -> list[int]:
+        """Забирает собранные части альбома по порядку message_id"""
+        if self.redis is None:
+            return sorted(self._albums.pop(media_group_id, []))
+        key = f'album:{media_group_id}'
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            message_ids, _ = await pipe.execute()
+        return sorted(int(message_id) for message_id in message_ids)
+
+
+albums = AlbumCollector()
+
+
 class Custom_message(StatesGroup):
     msg_custom = State()
 
@@ -20,129 +73,39 @@ class Custom_message(StatesGroup):
 async def function_custom_message(callback: CallbackQuery, state: FSMContext):
     await callback.answer('')
     await state.set_state(Custom_message.msg_custom)
-    await callback.message.answer(text='Введите ваше сообщение (или отправьте медиа):')
+    await callback.message.answer(text='Введите ваше сообщение (или отправьте медиа, можно альбомом):')
+
+
+@job_kind('custom', cost=lambda payload: len(payload['message_ids']))
+async def send_custom(bot: Bot, chat_id: int, payload: dict):
+    """Копирует сообщение администратора получателю: любой тип, форматирование и альбомы как есть"""
+    message_ids = payload['message_ids']
+    if len(message_ids) == 1:
+        await bot.copy_message(chat_id=chat_id, from_chat_id=payload['from_chat_id'], message_id=message_ids[0])
+    else:
+        await bot.copy_messages(chat_id=chat_id, from_chat_id=payload['from_chat_id'], message_ids=message_ids)
+
+
+async def launch_custom_broadcast(bot: Bot, state: FSMContext, admin_chat_id: int, from_chat_id: int, message_ids: list[int]):
+    await state.clear()
+    await start_broadcast(bot, 'custom', {'from_chat_id': from_chat_id, 'message_ids': message_ids}, admin_chat_id)
+
+
+async def collect_album(bot: Bot, state: FSMContext, admin_chat_id: int, from_chat_id: int, media_group_id: str):
+    # Части альбома приходят отдельными апдейтами — ждем, пока соберутся все
+    await asyncio.sleep(ALBUM_WAIT)
+    message_ids = await albums.take(media_group_id)
+    await launch_custom_broadcast(bot, state, admin_chat_id, from_chat_id, message_ids)
 
 
 @router.message(Custom_message.msg_custom)
 async def get_custom_message(message: Message, state: FSMContext, bot: Bot):
-    users = await rq.get_users()
-    success_count = 0
-    failure_count = 0
-
-    if message.text:
-        custom_text = message.text
-        for user in users:
-            try:
-                await bot.send_message(chat_id=user.tg_id, text=custom_text)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке сообщения пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    elif message.photo:
-        file_id = message.photo[-1].file_id
-        caption = message.caption
-        for user in users:
-            try:
-                await bot.send_photo(chat_id=user.tg_id, photo=file_id, caption=caption)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке фото пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    elif message.video:
-        file_id = message.video.file_id
-        caption = message.caption
-        for user in users:
-            try:
-                await bot.send_video(chat_id=user.tg_id, video=file_id, caption=caption)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке видео пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    elif message.document:
-        file_id = message.document.file_id
-        caption = message.caption
-        for user in users:
-            try:
-                await bot.send_document(chat_id=user.tg_id, document=file_id, caption=caption)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке документа пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-    
-    elif message.animation:
-        file_id = message.animation.file_id
-        caption = message.caption
-        for user in users:
-            try:
-                await bot.send_animation(chat_id=user.tg_id, animation=file_id, caption=caption)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке GIF пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    elif message.sticker:
-        file_id = message.sticker.file_id
-        for user in users:
-            try:
-                await bot.send_sticker(chat_id=user.tg_id, sticker=file_id)
-                if int(user.active) != 1:
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке стикера пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    else:
-        await bot.send_message(message.from_user.id, text='Неподдерживаемый тип сообщения.')
-        await state.clear()
+    if message.media_group_id is None:
+        await launch_custom_broadcast(bot, state, message.from_user.id, message.chat.id, [message.message_id])
         return
 
-    if success_count > 0:
-        await bot.send_message(message.from_user.id, text=f'Успешная рассылка. Отправлено {success_count} пользователям. Не удалось отправить {failure_count} пользователям.')
-    else:
-        await bot.send_message(message.from_user.id, text=f'Не успешная рассылка. Не удалось отправить {failure_count} пользователям.')
-
-    await state.clear()
\ No newline at end of file
+    if not await albums.add(message.media_group_id, message.message_id):
+        return
+    task = asyncio.create_task(collect_album(bot, state, message.from_user.id, message.chat.id, message.media_group_id))
+    _album_tasks.add(task)
+    task.add_done_callback(_album_tasks.discard)
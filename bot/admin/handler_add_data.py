@@ -10,6 +10,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import FSInputFile
 
 import database.requests as rq
+from database.catalog import catalog
 
 router = Router()
 
@@ -116,29 +117,11 @@ class DataHandler:
             logger.info(f"[CHECK] Проверка уникальности названия: {name}")
             
             try:
-                if self.data_type == DataType.GAID:
-                    existing_data = await rq.get_gaid(name)
-                else:
-                    existing_data = await rq.get_kurs(name)
-                    
-                if existing_data is None:
-                    error_msg = "⚠️ Ошибка при проверке уникальности названия."
-                    logger.error(error_msg)
-                    await message.answer(error_msg)
-                    return
-                    
-                # Проверяем, есть ли уже такой курс/гайд
-                try:
-                    existing_items = list(existing_data)
-                    if existing_items:
-                        warn_msg = f"⚠️ Данные с названием '{name}' уже существуют."
-                        logger.warning(warn_msg)
-                        await message.answer(warn_msg)
-                        return
-                except Exception as e:
-                    error_msg = f"[ERROR] Ошибка при проверке существующих данных: {str(e)}"
-                    logger.error(error_msg, exc_info=True)
-                    await message.answer("⚠️ Ошибка при проверке данных. Попробуйте позже.")
+                # Проверяем, есть ли уже такой курс/гайд (по кэшу каталога)
+                if await catalog.get_by_name(self.data_type, name):
+                    warn_msg = f"⚠️ Данные с названием '{name}' уже существуют."
+                    logger.warning(warn_msg)
+                    await message.answer(warn_msg)
                     return
                     
             except Exception as db_error:
@@ -1,12 +1,14 @@
 from aiogram import F, Router, Bot
 from aiogram.types import CallbackQuery
-from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
 
 import os
 
 import database.requests as rq
 import keyboards.keyboard as kb
+from database.catalog import catalog
+from utils.broadcast import job_kind, start_broadcast, get_active_broadcast
+from utils.product_card import send_product_file, PRODUCT_FILE_COST
 
 router = Router()
 
@@ -19,6 +21,12 @@ admin_id2 = os.getenv('ADMIN_ID2')
 intadmin_id2 = int(admin_id2)
 
 
+@job_kind('product', cost=lambda payload: PRODUCT_FILE_COST * len(payload['items']))
+async def send_product(bot: Bot, chat_id: int, payload: dict):
+    for item in payload['items']:
+        await send_product_file(bot, chat_id, payload['data_type'], item['name'], item['photo'], item['description'], item['file'])
+
+
 @router.callback_query(F.data.startswith('keyboardrassilka'))
 async def rassilka(callback: CallbackQuery):
     await callback.answer()
@@ -32,35 +40,15 @@ async def kurs(callback: CallbackQuery):
     await callback.message.answer(text='Все курсы в базе:', reply_markup=await kb.sendkeyboardkurs())
 
 
-@router.callback_query(F.data.startswith('sendkurs_'))
-async def kurssendall(callback: CallbackQuery, bot: Bot):
+@router.callback_query(kb.SendProduct.filter(F.data_type == 'kurs'))
+async def kurssendall(callback: CallbackQuery, callback_data: kb.SendProduct):
     await callback.answer('')
-    success_count = 0
-    failure_count = 0
-    selectkurs = callback.data.split('_')[1]
-    kurssel = await rq.get_kurs(selectkurs)
-    users = await rq.get_users()
-    for kurs in kurssel:
-        for user in users:
-            try:
-                await bot.send_photo(chat_id=user.tg_id, photo=kurs.photo_kurs, caption=kurs.description_kurs)
-                await bot.send_document(chat_id=user.tg_id, document=kurs.fail_kurs, caption=kurs.name_fail_kurs)
-                if int(user.active != 1):
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке документа пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-    
-    if success_count > 0:
-        await callback.message.answer(text=f'Успешная рассылка. Отправлено {success_count} пользователям. Не удалось отправить {failure_count} пользователям.')
-    else:
-        await callback.message.answer(text=f'Не успешная рассылка. Не удалось отправить {failure_count} пользователям.')
+    kurs = await catalog.get('kurs', callback_data.id)
+    if kurs is None:
+        await callback.message.answer(text='Товар не найден, возможно он уже удален.')
+        return
+    await callback.message.answer(text=f'Кому отправить курс «{kurs.name_fail_kurs}»?',
+                                  reply_markup=await kb.segment_keyboard('kurs', kurs.id))
 
 
 @router.callback_query(F.data == 'sendgaids')
@@ -69,32 +57,66 @@ async def gaids(callback: CallbackQuery):
     await callback.message.answer('Все гайды в базе:', reply_markup=await kb.sendkeyboardgaid())
 
 
-@router.callback_query(F.data.startswith('sendgaid_'))
-async def gaidsendall(callback: CallbackQuery, bot: Bot):
+@router.callback_query(kb.SendProduct.filter(F.data_type == 'gaid'))
+async def gaidsendall(callback: CallbackQuery, callback_data: kb.SendProduct):
+    await callback.answer('')
+    gaid = await catalog.get('gaid', callback_data.id)
+    if gaid is None:
+        await callback.message.answer(text='Товар не найден, возможно он уже удален.')
+        return
+    await callback.message.answer(text=f'Кому отправить гайд «{gaid.name_fail_gaid}»?',
+                                  reply_markup=await kb.segment_keyboard('gaid', gaid.id))
+
+
+def parse_segment(data_type: str, product_id: int, code: str) -> dict:
+    """Код сегмента из клавиатуры -> сегмент задания рассылки (см. database.requests.segment_filter)"""
+    if code == 'all':
+        return {'kind': 'all'}
+    if code == 'vnb':
+        return {'kind': 'viewed_not_bought', 'product_type': data_type, 'product_id': product_id}
+    if code == 'nb':
+        return {'kind': 'not_bought', 'product_type': data_type, 'product_id': product_id}
+    if code.startswith('in'):
+        return {'kind': 'inactive', 'days': int(code[2:])}
+    if code.startswith('b'):
+        return {'kind': 'bought', 'product_type': 'kurs', 'product_id': int(code[1:])}
+    raise ValueError(f'Неизвестный код сегмента: {code}')
+
+
+@router.callback_query(kb.SegmentChoice.filter())
+async def segmentsendall(callback: CallbackQuery, callback_data: kb.SegmentChoice, bot: Bot):
     await callback.answer('')
-    success_count = 0
-    failure_count = 0
-    getgaid = callback.data.split('_')[1]
-    gaidsel = await rq.get_gaid(getgaid)
-    users = await rq.get_users()
-    for gaid in gaidsel:
-        for user in users:
-            try:
-                await bot.send_photo(chat_id=user.tg_id, photo=gaid.photo_gaid, caption=gaid.description_gaid)
-                await bot.send_document(chat_id=user.tg_id, document=gaid.fail_gaid, caption=gaid.name_fail_gaid)
-                if int(user.active != 1):
-                    await rq.set_active(user.tg_id, 1)
-                success_count += 1
-            except TelegramBadRequest as e:
-                if "Запрещено: бот заблокирован пользователем" in str(e):
-                    await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-            except Exception as e:
-                print(f"Ошибка при отправке документа пользователю {user.tg_id}: {e}")
-                await rq.set_active(user.tg_id, 0)
-                failure_count += 1
-
-    if success_count > 0:
-        await callback.message.answer(text=f'Успешная рассылка. Отправлено {success_count} пользователям. Не удалось отправить {failure_count} пользователям.')
-    else:
-        await callback.message.answer(text=f'Не успешная рассылка. Не удалось отправить {failure_count} пользователям.')
+    data_type, product_id = callback_data.data_type, callback_data.product_id
+    item = await catalog.get(data_type, product_id)
+    if item is None:
+        await callback.message.answer(text='Товар не найден, возможно он уже удален.')
+        return
+
+    await callback.message.edit_reply_markup(reply_markup=None)
+    items = [{
+        'photo': getattr(item, f'photo_{data_type}'),
+        'description': getattr(item, f'description_{data_type}'),
+        'file': getattr(item, f'fail_{data_type}'),
+        'name': getattr(item, f'name_fail_{data_type}'),
+    }]
+    segment = parse_segment(data_type, product_id, callback_data.code)
+    await start_broadcast(bot, 'product', {'data_type': data_type, 'items': items, 'segment': segment}, callback.from_user.id)
+
+
+@router.callback_query(kb.BroadcastAction.filter())
+async def broadcast_control(callback: CallbackQuery, callback_data: kb.BroadcastAction):
+    action = callback_data.action
+    answers = {'pause': 'Рассылка на паузе', 'resume': 'Рассылка продолжается', 'cancel': 'Рассылка отменена'}
+    broadcast = get_active_broadcast(callback_data.job_id)
+    if broadcast is None:
+        # Рассылку может вести другая реплика бота: команда уходит ей через БД
+        if await rq.set_broadcast_control(callback_data.job_id, action):
+            await callback.answer(f'{answers[action]} (через несколько секунд)')
+            return
+        await callback.answer('Рассылка уже завершена')
+        await callback.message.edit_reply_markup(reply_markup=None)
+        return
+
+    broadcast.apply(action)
+    await callback.answer(answers[action])
+    await broadcast.update_panel()
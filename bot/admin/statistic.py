@@ -1,34 +1,49 @@
-from aiogram import F, Router, Bot
-from aiogram.types import CallbackQuery, FSInputFile
-import os
-import json
+from aiogram import F, Router, Bot, html
+from aiogram.types import CallbackQuery, BufferedInputFile
+
+import database.requests as rq
+from database.catalog import catalog
+from utils.analytics import views
 
 router = Router()
 
-GAID_DATA_JSON = "gaid_data.json"
-KURS_DATA_JSON = "kurs_data.json"
-GAID_DATA_TXT = "gaid_data.txt"
-KURS_DATA_TXT = "kurs_data.txt"
+# Лимит длины текстового сообщения в Telegram
+MESSAGE_LIMIT = 4096
 
+SECTIONS = {'gaid': 'Гайды', 'kurs': 'Курсы'}
 
-async def convert_json_to_txt(json_file, txt_file):
-    """Converts a JSON file to a TXT file."""
-    try:
-        with open(json_file, 'r', encoding='utf-8') as f_json:
-            data = json.load(f_json)
 
-        with open(txt_file, 'w', encoding='utf-8') as f_txt:
-            json.dump(data, f_txt, ensure_ascii=False, indent=4)
-        return True
-    except FileNotFoundError:
-        print(f"Error: JSON file {json_file} not found.")
-        return False
-    except json.JSONDecodeError:
-        print(f"Error: Invalid JSON format in {json_file}.")
-        return False
-    except Exception as e:
-        print(f"An error occurred during conversion: {e}")
-        return False
+def format_report(stats: dict, catalog_names: dict, markup: bool = True) -> str:
+    """Текст отчета; markup=False — без HTML, для отправки файлом"""
+    bold = html.bold if markup else str
+    quote = html.quote if markup else str
+
+    lines = ['📊 Статистика товаров']
+    for data_type, title in SECTIONS.items():
+        lines.append(f'\n{bold(title)}')
+        products = catalog_names[data_type]
+        product_ids = list(products) + sorted(pid for t, pid in stats if t == data_type and pid not in products)
+        if not product_ids:
+            lines.append('Нет товаров')
+        for product_id in product_ids:
+            row = stats.get((data_type, product_id), {})
+            name = quote(products.get(product_id, f'#{product_id} (удален)'))
+            lines.append(f"• {name}: просмотров {row.get('views', 0)} "
+                         f"(уникальных {row.get('viewers', 0)}), покупок {row.get('purchases', 0)}, "
+                         f"⭐️ {row.get('revenue', 0)}")
+    return '\n'.join(lines)
+
+
+async def collect_stats():
+    """Просмотры и покупки по каждому товару из product_views и purchases"""
+    # Просмотры из буфера, еще не записанные в БД, тоже попадают в отчет
+    await views.flush()
+    stats = await rq.get_product_stats()
+    catalog_names = {
+        data_type: {item.id: getattr(item, f'name_fail_{data_type}') for item in await catalog.all(data_type)}
+        for data_type in SECTIONS
+    }
+    return stats, catalog_names
 
 
 @router.callback_query(F.data.startswith('keyboardstatistika'))
@@ -39,26 +54,15 @@ async def statistica(callback: CallbackQuery, bot: Bot):
     await callback.message.edit_reply_markup(reply_markup=None)
     await bot.delete_message(chat_id=chat_id, message_id=last_message_id)
     try:
-        await callback.message.answer("Отправляю файлы статистики...")
-
-        # Convert JSON to TXT
-        gaid_converted = await convert_json_to_txt(GAID_DATA_JSON, GAID_DATA_TXT)
-        kurs_converted = await convert_json_to_txt(KURS_DATA_JSON, KURS_DATA_TXT)
-
-        try:
-            if gaid_converted and os.path.exists(GAID_DATA_TXT):
-                gaid_data_file = FSInputFile(GAID_DATA_TXT)
-                await bot.send_document(chat_id=chat_id, document=gaid_data_file)
-            else:
-                await callback.message.answer( f"Файл {GAID_DATA_JSON} не найден или не удалось его преобразовать.")
-
-            if kurs_converted and os.path.exists(KURS_DATA_TXT):
-                kurs_date_file = FSInputFile(KURS_DATA_TXT)
-                await bot.send_document(chat_id=chat_id, document=kurs_date_file)
-            else:
-                await callback.message.answer(f"Файл {KURS_DATA_JSON} не найден или не удалось его преобразовать.")
-        except Exception as e:
-            await callback.message.answer(f"Произошла ошибка при отправке файлов: {e}")
+        stats, catalog_names = await collect_stats()
+        report = format_report(stats, catalog_names)
+        if len(report) <= MESSAGE_LIMIT:
+            await callback.message.answer(report)
+        else:
+            # Большой каталог — отчет файлом
+            text = format_report(stats, catalog_names, markup=False)
+            await bot.send_document(chat_id=chat_id, document=BufferedInputFile(
+                text.encode('utf-8'), filename='statistics.txt'))
     except Exception as e:
         print(f"Ошибка в статистике: {e}")
-
+        await callback.message.answer(f"Произошла ошибка при сборе статистики: {html.quote(str(e))}")
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import time
+
+from sqlalchemy import select
+
+from database.models import async_session, Gaid, Kurs
+
+logger = logging.getLogger(__name__)
+
+MODELS = {'gaid': Gaid, 'kurs': Kurs}
+
+# Несколько реплик бота не видят invalidate() друг друга, поэтому для них
+# каталог перечитывается не реже раза в CATALOG_TTL секунд (0 — только по invalidate)
+CATALOG_TTL = float(os.getenv('CATALOG_TTL', 0))
+
+
+class Catalog:
+    """Каталог гайдов и курсов в памяти процесса.
+
+    Товары меняются несколько раз в месяц, а читаются на каждое нажатие,
+    поэтому каталог целиком держится в памяти: по id и по названию.
+    Функции database.requests, меняющие товары, вызывают invalidate(),
+    и следующее обращение перечитывает каталог из БД. version растет при
+    каждой перезагрузке — по ней сверяются производные кэши (клавиатуры).
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._stale = True
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        self._items = {data_type: [] for data_type in MODELS}
+        self._by_id = {data_type: {} for data_type in MODELS}
+        self._by_name = {data_type: {} for data_type in MODELS}
+
+    def invalidate(self):
+        self._stale = True
+
+    async def load(self):
+        async with self._lock:
+            await self._reload()
+
+    async def _reload(self):
+        # Сбрасываем флаг до запроса: invalidate() во время загрузки не потеряется
+        self._stale = False
+        items, by_id, by_name = {}, {}, {}
+        try:
+            async with async_session() as session:
+                for data_type, model in MODELS.items():
+                    result = await session.scalars(select(model).order_by(model.id))
+                    items[data_type] = result.all()
+        except Exception:
+            self._stale = True
+            raise
+        for data_type in MODELS:
+            by_id[data_type] = {item.id: item for item in items[data_type]}
+            by_name[data_type] = {}
+            for item in items[data_type]:
+                by_name[data_type].setdefault(getattr(item, f'name_fail_{data_type}'), []).append(item)
+        self._items, self._by_id, self._by_name = items, by_id, by_name
+        self._loaded_at = time.monotonic()
+        self.version += 1
+        logger.info(f"Каталог загружен (версия {self.version}): "
+                    f"гайдов {len(items['gaid'])}, курсов {len(items['kurs'])}")
+
+    async def _fresh(self):
+        if CATALOG_TTL and time.monotonic() - self._loaded_at > CATALOG_TTL:
+            self._stale = True
+        if not self._stale:
+            self.hits += 1
+            return
+        self.misses += 1
+        async with self._lock:
+            if self._stale:
+                await self._reload()
+
+    async def current_version(self) -> int:
+        await self._fresh()
+        return self.version
+
+    async def all(self, data_type: str) -> list:
+        await self._fresh()
+        return self._items[data_type]
+
+    async def get(self, data_type: str, product_id: int):
+        await self._fresh()
+        return self._by_id[data_type].get(product_id)
+
+    async def get_by_name(self, data_type: str, name: str) -> list:
+        """Список товаров с таким названием — для проверки дублей при добавлении"""
+        await self._fresh()
+        return self._by_name[data_type].get(name, [])
+
+    def stats(self) -> dict:
+        return {
+            'version': self.version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'gaids': len(self._items['gaid']),
+            'kurs': len(self._items['kurs']),
+        }
+
+
+catalog = Catalog()
@@ -1,11 +1,73 @@
-from sqlalchemy import BigInteger, String, Integer
+import os
+
+import logging
+
+from sqlalchemy import BigInteger, String, Integer, JSON, DateTime, Index, event, func, inspect, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
 
-engine = create_async_engine(url='sqlite+aiosqlite:///data/dbvoronkaasyabot.sqlite3')
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite+aiosqlite:///data/dbvoronkaasyabot.sqlite3')
+
+# Профили PRAGMA для каждого нового соединения SQLite. В WAL чтение каталога
+# не ждет записей рассылки, а synchronous=NORMAL в WAL теряет при сбое питания
+# только последние транзакции, но не портит базу.
+SQLITE_PROFILES = {
+    'tuned': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,  # в КиБ, т.е. ~64 МБ
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,  # мс
+    },
+    # Настройки SQLite по умолчанию, для сравнения в bench/sqlite_bench.py
+    'default': {},
+}
+SQLITE_PROFILE = os.getenv('SQLITE_PROFILE', 'tuned')
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))
+
+
+def sqlite_pragmas() -> dict:
+    """PRAGMA выбранного профиля; каждую можно переопределить через SQLITE_<NAME>, например SQLITE_MMAP_SIZE=0"""
+    pragmas = dict(SQLITE_PROFILES[SQLITE_PROFILE])
+    for name in SQLITE_PROFILES['tuned']:
+        value = os.getenv(f'SQLITE_{name.upper()}')
+        if value is not None:
+            pragmas[name] = value
+    return pragmas
+
+
+def engine_options(url: str) -> dict:
+    if ':memory:' in url or url.endswith('://'):
+        # База в памяти живет в одном соединении (StaticPool), размер пула неприменим
+        return {}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+    }
+
+
+engine = create_async_engine(url=DATABASE_URL, **engine_options(DATABASE_URL))
 
 async_session = async_sessionmaker(engine)
 
+logger = logging.getLogger(__name__)
+
+
+if engine.dialect.name == 'sqlite':
+    @event.listens_for(engine.sync_engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in sqlite_pragmas().items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
@@ -19,10 +81,18 @@ class User(Base):
     tg_name = mapped_column(String(35))
     active = mapped_column(Integer, default=1)
 
+    __table_args__ = (
+        # Выборка получателей рассылки: WHERE active = 1 AND id > :last_id ORDER BY id
+        Index('ix_users_active_id', 'active', 'id'),
+        # Цель ON CONFLICT в set_user: один пользователь — одна строка
+        Index('ix_users_tg_id', 'tg_id', unique=True),
+    )
 
 
 class Gaid(Base):
     __tablename__ = 'gaid'
+    # Покупки и просмотры ссылаются на id товара: id удаленного товара не должен достаться новому
+    __table_args__ = {'sqlite_autoincrement': True}
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name_fail_gaid = mapped_column(String(70))
@@ -35,6 +105,7 @@ class Gaid(Base):
 
 class Kurs(Base):
     __tablename__ = 'kurs'
+    __table_args__ = {'sqlite_autoincrement': True}
 
     id: Mapped[int] = mapped_column(primary_key=True) 
     name_fail_kurs = mapped_column(String(70))
@@ -45,6 +116,166 @@ class Kurs(Base):
     price_star_kurs = mapped_column(Integer())
 
 
+class ProductView(Base):
+    __tablename__ = 'product_views'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_tg_id = mapped_column(BigInteger)
+    product_type = mapped_column(String(10))
+    product_id = mapped_column(Integer)
+    viewed_at = mapped_column(DateTime, server_default=func.now())
+
+    __table_args__ = (
+        # Сегменты "смотрели товар X" и "неактивные N дней"
+        Index('ix_product_views_product_user', 'product_type', 'product_id', 'user_tg_id'),
+        Index('ix_product_views_user_time', 'user_tg_id', 'viewed_at'),
+    )
+
+
+class Purchase(Base):
+    __tablename__ = 'purchases'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_tg_id = mapped_column(BigInteger)
+    product_type = mapped_column(String(10))
+    product_id = mapped_column(Integer)
+    amount = mapped_column(Integer)
+    telegram_payment_charge_id = mapped_column(String(255))
+    purchased_at = mapped_column(DateTime, server_default=func.now())
+
+    __table_args__ = (
+        # Сегменты "купили товар X" / "еще не купили" и "неактивные N дней"
+        Index('ix_purchases_product_user', 'product_type', 'product_id', 'user_tg_id'),
+        # /mypurchases и сегмент "неактивные N дней"
+        Index('ix_purchases_user_time', 'user_tg_id', 'purchased_at'),
+        # Повторно доставленный Telegram successful_payment не создает вторую покупку
+        Index('ux_purchases_charge_id', 'telegram_payment_charge_id', unique=True),
+    )
+
+
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind = mapped_column(String(20))
+    payload = mapped_column(JSON)
+    admin_chat_id = mapped_column(BigInteger)
+    status = mapped_column(String(10), default='running')
+    # users.id последнего получателя, до которого рассылка подтверждена без пропусков
+    cursor = mapped_column(Integer, default=0)
+    total = mapped_column(Integer, default=0)
+    sent = mapped_column(Integer, default=0)
+    failed = mapped_column(Integer, default=0)
+    # Реплика бота, которая ведет рассылку, и до какого момента (UTC) за ней аренда.
+    # Аренда продлевается с каждым сохранением курсора; истекшую подхватывает другая реплика
+    owner = mapped_column(String(64), nullable=True)
+    lease_until = mapped_column(DateTime, nullable=True)
+    # Пауза/продолжение/отмена, нажатые на другой реплике: владелец применяет и очищает
+    control = mapped_column(String(10), nullable=True)
+    created_at = mapped_column(DateTime, server_default=func.now())
+    updated_at = mapped_column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+def merge_duplicate_users(conn):
+    """Склеивает дубли users.tg_id, иначе уникальный индекс не создать.
+
+    Остается самая ранняя строка (рассылки идут по порядку id), имя берется
+    из последней, а active — максимальный среди дублей.
+    """
+    duplicates = conn.execute(text(
+        'SELECT COUNT(*) - COUNT(DISTINCT tg_id) FROM users WHERE tg_id IS NOT NULL'
+    )).scalar()
+    if not duplicates:
+        return
+    conn.execute(text('''
+        UPDATE users SET
+            tg_name = (SELECT u.tg_name FROM users u WHERE u.tg_id = users.tg_id ORDER BY u.id DESC LIMIT 1),
+            active = (SELECT MAX(u.active) FROM users u WHERE u.tg_id = users.tg_id)
+        WHERE id IN (SELECT MIN(id) FROM users WHERE tg_id IS NOT NULL GROUP BY tg_id HAVING COUNT(*) > 1)
+    '''))
+    conn.execute(text('''
+        DELETE FROM users
+        WHERE tg_id IS NOT NULL AND id NOT IN (SELECT MIN(id) FROM users WHERE tg_id IS NOT NULL GROUP BY tg_id)
+    '''))
+    logger.warning(f"Удалено дублей пользователей: {duplicates}")
+
+
+def merge_duplicate_purchases(conn):
+    """До уникального индекса по charge id одна оплата могла записаться дважды"""
+    result = conn.execute(text('''
+        DELETE FROM purchases
+        WHERE telegram_payment_charge_id IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM purchases WHERE telegram_payment_charge_id IS NOT NULL
+            GROUP BY telegram_payment_charge_id
+        )
+    '''))
+    if result.rowcount:
+        logger.warning(f"Удалено дублей покупок: {result.rowcount}")
+
+
+def add_missing_columns(conn):
+    """create_all не добавляет новые столбцы в уже существующие таблицы.
+
+    Добавляются только nullable-столбцы без значений по умолчанию, остальное
+    требует ручной миграции.
+    """
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable or column.default is not None or column.server_default is not None:
+                raise RuntimeError(f'Столбец {table.name}.{column.name} нужно добавить вручную')
+            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(conn.dialect)}'))
+            logger.info(f'Добавлен столбец {table.name}.{column.name}')
+
+
+def enable_product_autoincrement(conn):
+    """Пересоздает таблицы товаров, созданные без AUTOINCREMENT.
+
+    Без него SQLite отдает новому товару id последнего удаленного, и покупатели
+    удаленного товара получают доступ к новому. Счетчик id начинается после
+    наибольшего id, который встречается в таблице, покупках и просмотрах.
+    """
+    if conn.dialect.name != 'sqlite':
+        return
+    for model in (Gaid, Kurs):
+        table = model.__table__
+        sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                           {'name': table.name}).scalar()
+        if 'AUTOINCREMENT' in sql.upper():
+            continue
+        columns = ', '.join(column.name for column in table.columns)
+        conn.execute(text(f'ALTER TABLE {table.name} RENAME TO {table.name}_old'))
+        table.create(conn)
+        conn.execute(text(f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {table.name}_old'))
+        conn.execute(text(f'DROP TABLE {table.name}_old'))
+        last_id = conn.execute(text(f'''
+            SELECT MAX(id) FROM (
+                SELECT MAX(id) AS id FROM {table.name}
+                UNION ALL SELECT MAX(product_id) FROM purchases WHERE product_type = :type
+                UNION ALL SELECT MAX(product_id) FROM product_views WHERE product_type = :type
+            )
+        '''), {'type': table.name}).scalar() or 0
+        conn.execute(text('DELETE FROM sqlite_sequence WHERE name = :name'), {'name': table.name})
+        conn.execute(text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'),
+                     {'name': table.name, 'seq': last_id})
+        logger.warning(f'Таблица {table.name} пересоздана с AUTOINCREMENT, новые id начнутся после {last_id}')
+
+
+def create_missing_indexes(conn):
+    """create_all не добавляет новые индексы в уже существующие таблицы"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
 async def async_main():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+        await conn.run_sync(enable_product_autoincrement)
+        await conn.run_sync(merge_duplicate_users)
+        await conn.run_sync(merge_duplicate_purchases)
+        await conn.run_sync(create_missing_indexes)
\ No newline at end of file
@@ -1,6 +1,9 @@
 from database.models import async_session
-from database.models import User, Gaid, Kurs
-from sqlalchemy import select, text
+from database.models import User, Gaid, Kurs, BroadcastJob, ProductView, Purchase
+from database.catalog import catalog
+from sqlalchemy import select, text, update, delete, func, exists, and_, or_, true
+from sqlalchemy.dialects.sqlite import insert
+from datetime import datetime, timedelta, timezone
 import logging
 
 
@@ -16,24 +19,98 @@ logger = logging.getLogger(__name__)
 
 
 async def set_user(tg_id, tg_name):
+    """Регистрация по /start одним запросом: новая строка или обновление имени.
+
+    Повторный /start значит, что бот снова доступен пользователю, поэтому
+    он возвращается в рассылки.
+    """
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == tg_id))
+        stmt = insert(User).values(tg_id=tg_id, tg_name=tg_name, active=1)
+        stmt = stmt.on_conflict_do_update(index_elements=[User.tg_id],
+                                          set_={'tg_name': stmt.excluded.tg_name, 'active': 1})
+        await session.execute(stmt)
+        await session.commit()
 
-        if not user:
-            session.add(User(tg_id=tg_id,tg_name=tg_name))
-            await session.commit()
 
+def segment_filter(segment=None):
+    """Условие на users для сегмента рассылки.
+
+    segment — словарь из задания рассылки:
+      {'kind': 'all'}
+      {'kind': 'viewed_not_bought', 'product_type': 'kurs', 'product_id': 1}
+      {'kind': 'not_bought', 'product_type': 'kurs', 'product_id': 1}
+      {'kind': 'bought', 'product_type': 'kurs', 'product_id': 1}
+      {'kind': 'inactive', 'days': 30} — ни просмотров, ни покупок за N дней
+    """
+    kind = (segment or {}).get('kind', 'all')
+    if kind == 'all':
+        return true()
+
+    if kind == 'inactive':
+        since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=segment['days'])
+        viewed = exists().where(ProductView.user_tg_id == User.tg_id, ProductView.viewed_at >= since)
+        bought = exists().where(Purchase.user_tg_id == User.tg_id, Purchase.purchased_at >= since)
+        return and_(~viewed, ~bought)
+
+    viewed = exists().where(
+        ProductView.product_type == segment['product_type'],
+        ProductView.product_id == segment['product_id'],
+        ProductView.user_tg_id == User.tg_id,
+    )
+    bought = exists().where(
+        Purchase.product_type == segment['product_type'],
+        Purchase.product_id == segment['product_id'],
+        Purchase.user_tg_id == User.tg_id,
+    )
+    if kind == 'viewed_not_bought':
+        return and_(viewed, ~bought)
+    if kind == 'not_bought':
+        return ~bought
+    if kind == 'bought':
+        return bought
+    raise ValueError(f'Неизвестный сегмент: {kind}')
 
-async def get_users():
+
+async def count_active_users(after_id=0, segment=None):
     async with async_session() as session:
-        return await session.scalars(select(User))
-    
+        return await session.scalar(
+            select(func.count()).where(User.active == 1, User.id > after_id, segment_filter(segment))
+        )
+
+
+async def iter_active_users(after_id=0, page_size=500, segment=None):
+    """Постранично отдает (id, tg_id) активных пользователей сегмента по возрастанию id.
+
+    Страницы выбираются по ключу (id > последнего), поэтому память не зависит от
+    размера таблицы, а каждая страница читается в своей короткой сессии.
+    """
+    condition = segment_filter(segment)
+    last_id = after_id
+    while True:
+        async with async_session() as session:
+            result = await session.execute(
+                select(User.id, User.tg_id)
+                .where(User.active == 1, User.id > last_id, condition)
+                .order_by(User.id)
+                .limit(page_size)
+            )
+            page = result.all()
+        for user in page:
+            yield user
+        if len(page) < page_size:
+            return
+        last_id = page[-1].id
 
-async def set_active(tg_id, active):
+
+async def set_active_many(changes):
+    """Массовое обновление users.active: одна транзакция и executemany на пачку [(tg_id, active), ...]"""
+    if not changes:
+        return
     async with async_session() as session:
-        newstate = text("UPDATE users SET active=:active WHERE tg_id=:tg_id")
-        newstate = newstate.bindparams(tg_id=tg_id, active=active)
-        await session.execute(newstate)
+        await session.execute(
+            text("UPDATE users SET active=:active WHERE tg_id=:tg_id"),
+            [{'tg_id': tg_id, 'active': active} for tg_id, active in changes]
+        )
         await session.commit()
 
 
@@ -41,60 +118,52 @@ async def add_gaid(name_fail_gaid, photo_gaid, description_gaid, fail_gaid, loca
     async with async_session() as session:
         session.add(Gaid(name_fail_gaid=name_fail_gaid, photo_gaid=photo_gaid, description_gaid=description_gaid, fail_gaid=fail_gaid, local_path_gaid=local_path_gaid, price_star_gaid=price_star_gaid))
         await session.commit()
+        catalog.invalidate()
 
     
 async def add_kurs(name_fail_kurs, photo_kurs, description_kurs, fail_kurs, local_path_kurs, price_star_kurs):
     async with async_session() as session:
         session.add(Kurs(name_fail_kurs=name_fail_kurs, photo_kurs=photo_kurs, description_kurs=description_kurs, fail_kurs=fail_kurs, local_path_kurs=local_path_kurs, price_star_kurs=price_star_kurs))
         await session.commit()
+        catalog.invalidate()
 
 
-async def select_gaid():
+async def drop_table_gaid(gaid_id):
     async with async_session() as session:
-        return await session.scalars(select(Gaid))
-    
+        await session.execute(delete(Gaid).where(Gaid.id == gaid_id))
+        await session.commit()
+        catalog.invalidate()
 
-async def select_kurs():
-    async with async_session() as session:
-        return await session.scalars(select(Kurs))
-    
 
-async def get_gaid(selection_id):
+async def drop_table_kurs(kurs_id):
     async with async_session() as session:
-        result = await session.scalars(select(Gaid).where(Gaid.name_fail_gaid == selection_id))
-        return result.all()
-    
-
-async def get_kurs(selection_id):
-    async with async_session() as session:
-        result = await session.scalars(select(Kurs).where(Kurs.name_fail_kurs == selection_id))
-        return result.all()
-    
+        await session.execute(delete(Kurs).where(Kurs.id == kurs_id))
+        await session.commit()
+        catalog.invalidate()
 
-async def proverka_gaids():
-    async with async_session() as session:
-        return await session.scalar(select(Gaid.id))
-    
 
-async def proverka_kurss():
-    async with async_session() as session:
-        return await session.scalar(select(Kurs.id))
-    
+async def get_products_page(data_type, cursor=0, direction='next', page_size=10):
+    """Страница каталога по ключу id, без OFFSET: next — товары с id > cursor, prev — с id < cursor.
 
-async def drop_table_gaid(selection_id):
+    Возвращает (товары, есть_предыдущая, есть_следующая).
+    """
+    model = {'gaid': Gaid, 'kurs': Kurs}[data_type]
     async with async_session() as session:
-        namegaid = await session.scalars(select(Gaid).where(Gaid.name_fail_gaid == selection_id))
-        for gaid in namegaid:
-            await session.delete(gaid)
-        await session.commit()
-
+        if direction == 'prev':
+            result = await session.scalars(
+                select(model).where(model.id < cursor).order_by(model.id.desc()).limit(page_size + 1)
+            )
+            items = result.all()
+            if items:
+                return items[:page_size][::-1], len(items) > page_size, True
+            # Предыдущие товары удалили — показываем начало каталога
+            cursor = 0
 
-async def drop_table_kurs(selection_id):
-    async with async_session() as session:
-        namekurs = await session.scalars(select(Kurs).where(Kurs.name_fail_kurs == selection_id))
-        for kurs in namekurs:
-            await session.delete(kurs)
-        await session.commit()
+        result = await session.scalars(
+            select(model).where(model.id > cursor).order_by(model.id).limit(page_size + 1)
+        )
+        items = result.all()
+        return items[:page_size], cursor > 0, len(items) > page_size
 
 
 async def get_all_gaids():
@@ -111,6 +180,7 @@ async def update_gaid_file_id(gaid_name, new_file_id):
         if gaid:
             gaid.fail_gaid = new_file_id
             await session.commit()
+            catalog.invalidate()
 
 async def update_kurs_file_id(kurs_name, new_file_id):
     async with async_session() as session:
@@ -118,3 +188,159 @@ async def update_kurs_file_id(kurs_name, new_file_id):
         if kurs:
             kurs.fail_kurs = new_file_id
             await session.commit()
+            catalog.invalidate()
+
+
+def _lease_until(lease_seconds):
+    return datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=lease_seconds)
+
+
+async def create_broadcast_job(kind, payload, admin_chat_id, total, owner=None, lease_seconds=0):
+    async with async_session() as session:
+        job = BroadcastJob(kind=kind, payload=payload, admin_chat_id=admin_chat_id, total=total,
+                           owner=owner, lease_until=_lease_until(lease_seconds) if owner else None)
+        session.add(job)
+        await session.flush()
+        job_id = job.id
+        await session.commit()
+        return job_id
+
+
+async def get_broadcast_job(job_id):
+    async with async_session() as session:
+        return await session.get(BroadcastJob, job_id)
+
+
+async def get_unfinished_broadcast_jobs():
+    async with async_session() as session:
+        result = await session.scalars(select(BroadcastJob).where(BroadcastJob.status.in_(('running', 'paused'))).order_by(BroadcastJob.id))
+        return result.all()
+
+
+async def claim_broadcast_job(job_id, owner, lease_seconds):
+    """Забирает незавершенную рассылку, если у нее нет владельца или его аренда истекла.
+
+    Один UPDATE с условием: из нескольких реплик рассылку получит ровно одна.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    async with async_session() as session:
+        result = await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id,
+                   BroadcastJob.status.in_(('running', 'paused')),
+                   or_(BroadcastJob.owner.is_(None), BroadcastJob.lease_until.is_(None),
+                       BroadcastJob.lease_until < now))
+            .values(owner=owner, lease_until=_lease_until(lease_seconds))
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def save_broadcast_checkpoint(job_id, cursor, sent, failed, status='running', owner=None, lease_seconds=0, total=None):
+    """Сохраняет курсор, счетчики и, если передан, пересчитанный total рассылки.
+
+    С owner запись идет, только пока рассылка за этой репликой: lease_seconds
+    продлевает аренду, 0 — освобождает. False — рассылку забрала другая реплика.
+    """
+    query = update(BroadcastJob).where(BroadcastJob.id == job_id)
+    values = {'cursor': cursor, 'sent': sent, 'failed': failed, 'status': status}
+    if total is not None:
+        values['total'] = total
+    if owner is not None:
+        query = query.where(BroadcastJob.owner == owner)
+        values.update(owner=owner if lease_seconds else None,
+                      lease_until=_lease_until(lease_seconds) if lease_seconds else None)
+    async with async_session() as session:
+        result = await session.execute(query.values(**values))
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def set_broadcast_control(job_id, action):
+    """Передает паузу/продолжение/отмену реплике, которая ведет рассылку. False — рассылка завершена"""
+    async with async_session() as session:
+        result = await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id, BroadcastJob.status.in_(('running', 'paused')))
+            .values(control=action)
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def take_broadcast_control(job_id, owner):
+    """Забирает команду для рассылки, переданную с другой реплики (или None)"""
+    async with async_session() as session:
+        action = await session.scalar(
+            select(BroadcastJob.control).where(BroadcastJob.id == job_id, BroadcastJob.owner == owner)
+        )
+        if action is None:
+            return None
+        # Сравнение с прочитанным значением: новая команда, пришедшая между запросами, не сотрется
+        await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id, BroadcastJob.control == action)
+            .values(control=None)
+        )
+        await session.commit()
+        return action
+
+
+async def add_product_views(views):
+    """Пачка просмотров одним executemany: [{'user_tg_id', 'product_type', 'product_id', 'viewed_at'}, ...]"""
+    if not views:
+        return
+    async with async_session() as session:
+        await session.execute(insert(ProductView), views)
+        await session.commit()
+
+
+async def get_product_stats():
+    """Агрегаты по товарам: {(product_type, product_id): {'views', 'viewers', 'purchases', 'revenue'}}"""
+    stats = {}
+    async with async_session() as session:
+        views = await session.execute(
+            select(ProductView.product_type, ProductView.product_id,
+                   func.count(), func.count(ProductView.user_tg_id.distinct()))
+            .group_by(ProductView.product_type, ProductView.product_id)
+        )
+        for product_type, product_id, count, viewers in views:
+            stats[(product_type, product_id)] = {'views': count, 'viewers': viewers, 'purchases': 0, 'revenue': 0}
+        purchases = await session.execute(
+            select(Purchase.product_type, Purchase.product_id, func.count(), func.coalesce(func.sum(Purchase.amount), 0))
+            .group_by(Purchase.product_type, Purchase.product_id)
+        )
+        for product_type, product_id, count, revenue in purchases:
+            row = stats.setdefault((product_type, product_id), {'views': 0, 'viewers': 0})
+            row.update(purchases=count, revenue=revenue)
+    return stats
+
+
+async def add_purchase(user_tg_id, product_type, product_id, amount, telegram_payment_charge_id):
+    """Записывает покупку; False, если эта оплата (charge id) уже записана"""
+    async with async_session() as session:
+        stmt = insert(Purchase).values(user_tg_id=user_tg_id, product_type=product_type, product_id=product_id,
+                                       amount=amount, telegram_payment_charge_id=telegram_payment_charge_id)
+        result = await session.execute(stmt.on_conflict_do_nothing(index_elements=[Purchase.telegram_payment_charge_id]))
+        await session.commit()
+        return result.rowcount > 0
+
+
+async def get_user_purchases(user_tg_id):
+    """Купленные товары пользователя без повторов, последние покупки первыми: [(product_type, product_id), ...]"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(Purchase.product_type, Purchase.product_id)
+            .where(Purchase.user_tg_id == user_tg_id)
+            .group_by(Purchase.product_type, Purchase.product_id)
+            .order_by(func.max(Purchase.purchased_at).desc())
+        )
+        return result.all()
+
+
+async def has_purchase(user_tg_id, product_type, product_id):
+    async with async_session() as session:
+        return await session.scalar(
+            select(exists().where(Purchase.product_type == product_type, Purchase.product_id == product_id,
+                                  Purchase.user_tg_id == user_tg_id))
+        )
@@ -2,18 +2,21 @@ import logging
 import json
 import os
 import time
-import transliterate
 from datetime import datetime, timezone
 from logging.handlers import RotatingFileHandler
 
-from aiogram import F, Router, html, Bot
+from aiogram import F, Router, Bot
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery
-from aiogram.fsm.state import StatesGroup, State
+from aiogram.types import Message, CallbackQuery, PreCheckoutQuery
 from aiogram.fsm.context import FSMContext
 
 import keyboards.keyboard as kb
 import database.requests as rq
+from database.catalog import catalog
+from utils.product_card import send_product_card
+from utils.analytics import views
+from utils.invoices import invoice_fields, invoice_links, parse_invoice_payload
 
 # Настройка логгера
 class JsonFormatter(logging.Formatter):
@@ -79,46 +82,15 @@ def log_user_action(func):
             raise
     return wrapper
 
-# Классы состояний
-class UserSelectionStates(StatesGroup):
-    waiting_for_selection = State()
-    selected_gaid = State()
-    selected_kurs = State()
 
 # Базовый класс для обработки данных
 class OutputDataHandler:
     def __init__(self, data_type: str):
         self.data_type = data_type
-        self.data_file = f"{data_type}_data.json"
-        
-    def transliterate_filename(self, filename):
-        """Транслитерирует имя файла с русского на английский."""
-        try:
-            return transliterate.translit(filename, 'ru', reversed=True)
-        except transliterate.exceptions.TranslitException:
-            logger.warning(f"Не удалось выполнить транслитерацию '{filename}'")
-            return filename
-    
-    def load_data(self):
-        """Загружает данные из JSON файла."""
-        if os.path.exists(self.data_file):
-            with open(self.data_file, "r", encoding='utf-8') as f:
-                try:
-                    return json.load(f)
-                except json.JSONDecodeError:
-                    logger.error(f"Ошибка декодирования JSON из {self.data_file}")
-                    return {}
-        return {}
-    
-    def save_data(self, data):
-        """Сохраняет данные в JSON файл."""
-        with open(self.data_file, "w", encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
     
     async def start(self, message: Message, bot: Bot):
         """Начало работы с данными."""
-        check_func = getattr(rq, f'proverka_{self.data_type}s')
-        if await check_func() is None:
+        if not await catalog.all(self.data_type):
             logger.warning(f"Нет доступных {self.data_type}ов")
             data_name = "гайд" if self.data_type == "gaid" else "курс"
             await bot.send_message(message.from_user.id, f'Пока {data_name}ов нет')
@@ -134,7 +106,7 @@ class OutputDataHandler:
             except Exception as e:
                 logger.error(f"Ошибка при выводе клавиатуры, слишком большое количество символов {e}")
             
-    async def select(self, callback: CallbackQuery, state: FSMContext):
+    async def select(self, callback: CallbackQuery, callback_data: kb.SelectProduct, bot: Bot):
         """Обработка выбора конкретного элемента."""
         await callback.answer('')
 
@@ -142,110 +114,73 @@ class OutputDataHandler:
             logger.error("Нет данных пользователя в callback")
             return
 
-        user_name = callback.from_user.full_name
-        admin_id = os.getenv('ADMIN_ID')
-        selection_id = callback.data.split('_')[1] 
-        
-        # Сохранение выбранного элемента в состояние
-        await state.update_data(
-            selection_id=selection_id,
-            user_id=callback.from_user.id,
-            user_name=user_name,
-            admin_id=admin_id,
-            data_type=self.data_type
-        )
-
-        if self.data_type == 'gaid':
-            await state.set_state(UserSelectionStates.selected_gaid)
-        else:
-            await state.set_state(UserSelectionStates.selected_kurs)
-        
-        # Сохранение в JSON
-        data = self.load_data()
-        if str(user_name) not in data:
-            data[str(user_name)] = []
-        
-        get_func = getattr(rq, f'get_{self.data_type}')
-        items = await get_func(selection_id)
-        if not items:
-            await logger.error("Элемент не найден в базе данных")
+        item = await catalog.get(self.data_type, callback_data.id)
+        if item is None:
+            logger.error("Элемент не найден в базе данных")
             return
+
+        # Просмотр для статистики и сегментов рассылок, в БД уходит пачкой
+        views.record(callback.from_user.id, self.data_type, item.id)
         
-        for item in items:
-            transliterated_name = self.transliterate_filename(
-                item.name_fail_gaid if self.data_type == 'gaid' else item.name_fail_kurs
-            )
-            
-            if transliterated_name not in data[str(user_name)]:
-                data[str(user_name)].append(transliterated_name)
-        
-        self.save_data(data)
-        
-        # Отправка информации о выбранном элементе
-        for item in items:
-            photo_field = getattr(item, f'photo_{self.data_type}')
-            name_field = getattr(item, f'name_fail_{self.data_type}')
-            description_field = getattr(item, f'description_{self.data_type}')
-            price_star_field = getattr(item, f'price_star_{self.data_type}')
-
-
-            await callback.message.answer_photo(photo_field)
-            await callback.message.answer(
-                f'{html.bold("Гайд:" if self.data_type == "gaid" else "Курс:")} {name_field}\n\n'
-                f'{html.bold("Описание:")} {description_field}\n\n\n'
-                f'{html.bold("Стоимость в звездах:")} {price_star_field}',
-                reply_markup=getattr(kb, f'payment_keyboard_{self.data_type}')
-            )
+        # Кнопка ведет сразу на оплату по закэшированной ссылке; если ссылку
+        # создать не удалось — прежняя кнопка с answer_invoice
+        try:
+            link = await invoice_links.get(bot, self.data_type, item)
+        except Exception as e:
+            logger.error(f"Не удалось получить ссылку на оплату {self.data_type} #{item.id}: {e}")
+            link = None
+
+        # Отправка карточки выбранного элемента одним сообщением
+        await send_product_card(
+            bot,
+            callback.from_user.id,
+            self.data_type,
+            name=getattr(item, f'name_fail_{self.data_type}'),
+            photo=getattr(item, f'photo_{self.data_type}'),
+            description=getattr(item, f'description_{self.data_type}'),
+            price=getattr(item, f'price_star_{self.data_type}'),
+            reply_markup=await kb.payment_keyboard(self.data_type, item.id, link)
+        )
     
-    async def buy_with_stars(self, callback: CallbackQuery, state: FSMContext):
+    async def buy_with_stars(self, callback: CallbackQuery, callback_data: kb.BuyProduct):
         """Покупка с использованием звезд."""
-        data = await state.get_data()
-        selection_id = data.get('selection_id')
-        
-        if not selection_id:
-            await logger.error("Ошибка: не выбран элемент")
+        item = await catalog.get(self.data_type, callback_data.id)
+        if item is None:
+            logger.error(f"Товар {self.data_type} #{callback_data.id} уже удален")
+            await callback.answer('Товар больше не продается')
             return
-            
-        get_func = getattr(rq, f'get_{self.data_type}')
-        items = await get_func(selection_id)
-        
-        for item in items:
-            name_field = getattr(item, f'name_fail_{self.data_type}')
-            description_field = getattr(item, f'description_{self.data_type}')
-            price_star_field = getattr(item, f'price_star_{self.data_type}')
-            
-            await callback.message.answer_invoice(
-                title=name_field,
-                description=description_field,
-                provider_token='',
-                currency="XTR",
-                payload=self.data_type,
-                prices=[LabeledPrice(label="XTR", amount=price_star_field)]
-            )
+
+        await callback.message.answer_invoice(**invoice_fields(self.data_type, item))
         await callback.answer()
     
-    async def successful_payment(self, message: Message, bot: Bot, state: FSMContext):
-        """Обработка успешной оплаты."""
-        data = await state.get_data()
-        selection_id = data.get('selection_id')
-        
-        if not selection_id:
-            await logger.error("Ошибка: не выбран элемент")
+    async def successful_payment(self, message: Message, bot: Bot):
+        """Обработка успешной оплаты: товар берется из payload счета."""
+        payment = message.successful_payment
+        invoice = parse_invoice_payload(payment.invoice_payload)
+
+        # Сначала покупка, потом файл: повторно доставленный апдейт с тем же charge id
+        # не отправит файл второй раз, а при сбое отправки файл есть в /mypurchases.
+        # Покупка записывается и для товара, удаленного после pre_checkout: деньги списаны
+        if not await rq.add_purchase(message.from_user.id, self.data_type, invoice.id,
+                                     payment.total_amount, payment.telegram_payment_charge_id):
+            logger.warning(f"Оплата {payment.telegram_payment_charge_id} уже обработана, файл не отправляется повторно")
             return
-            
-        get_func = getattr(rq, f'get_{self.data_type}')
-        items = await get_func(selection_id)
-        
-        for item in items:
-            file_field = getattr(item, f'fail_{self.data_type}')
-            await bot.send_document(
-                chat_id=message.from_user.id,
-                document=file_field,
-                caption=f"{'Гайд' if self.data_type == 'gaid' else 'Курс'}: {getattr(item, f'name_fail_{self.data_type}')}"
-            )
-
-        await state.clear()    
-        logger.info(f"Состояние очищено после успешной оплаты для пользователя {message.from_user.id}")
+
+        item = await catalog.get(self.data_type, invoice.id)
+        if item is None:
+            logger.error(f"Оплачен удаленный товар {self.data_type} #{invoice.id}, пользователь {message.from_user.id}, "
+                         f"charge {payment.telegram_payment_charge_id}")
+            await message.answer('Товар был удален после оплаты, напишите администратору — мы все решим.')
+            return
+        await self.send_file(bot, message.from_user.id, item)
+
+    async def send_file(self, bot: Bot, chat_id: int, item):
+        """Файл купленного товара: после оплаты и по /mypurchases"""
+        await bot.send_document(
+            chat_id=chat_id,
+            document=getattr(item, f'fail_{self.data_type}'),
+            caption=f"{'Гайд' if self.data_type == 'gaid' else 'Курс'}: {getattr(item, f'name_fail_{self.data_type}')}"
+        )
     
 
 # Создаем экземпляры обработчиков
@@ -258,25 +193,40 @@ kurs_handler = OutputDataHandler('kurs')
 async def gaid_start(message: Message, bot: Bot):
     await gaid_handler.start(message, bot)
 
-@router.callback_query(F.data.startswith('selectgaid_'))
+@router.callback_query(kb.SelectProduct.filter(F.data_type == 'gaid'))
 @log_user_action
-async def gaid_select(callback: CallbackQuery, state: FSMContext):
-    await gaid_handler.select(callback, state)
+async def gaid_select(callback: CallbackQuery, callback_data: kb.SelectProduct, bot: Bot):
+    await gaid_handler.select(callback, callback_data, bot)
 
-@router.callback_query(F.data.startswith('stars_gaid'))
+@router.callback_query(kb.BuyProduct.filter(F.data_type == 'gaid'))
 @log_user_action
-async def buy_gaid(callback: CallbackQuery, state: FSMContext):
-    await gaid_handler.buy_with_stars(callback, state)
+async def buy_gaid(callback: CallbackQuery, callback_data: kb.BuyProduct):
+    await gaid_handler.buy_with_stars(callback, callback_data)
 
 @router.pre_checkout_query()
 @log_user_action
 async def pre_checkout_query_gaid(event: PreCheckoutQuery) -> None:
+    """Проверка перед списанием звезд, общая для гайдов и курсов: товар еще продается по цене из счета"""
+    invoice = parse_invoice_payload(event.invoice_payload)
+    if invoice is None or invoice.data_type not in ('gaid', 'kurs'):
+        await event.answer(ok=False, error_message='Счет устарел, откройте товар заново.')
+        return
+    item = await catalog.get(invoice.data_type, invoice.id)
+    if item is None:
+        await event.answer(ok=False, error_message='Этот товар больше не продается.')
+        return
+    price = getattr(item, f'price_star_{invoice.data_type}')
+    if event.currency != 'XTR' or event.total_amount != price:
+        logger.warning(f"Цена в счете {event.total_amount} {event.currency} не совпадает с ценой товара "
+                       f"{invoice.data_type} #{invoice.id}: {price}")
+        await event.answer(ok=False, error_message='Цена изменилась, откройте товар заново.')
+        return
     await event.answer(ok=True)
 
-@router.message(F.successful_payment.invoice_payload == 'gaid')
+@router.message(F.successful_payment.invoice_payload.startswith('invoice:gaid:'))
 @log_user_action
-async def successful_payment_gaid(message: Message, bot: Bot, state: FSMContext):
-    await gaid_handler.successful_payment(message, bot, state)
+async def successful_payment_gaid(message: Message, bot: Bot):
+    await gaid_handler.successful_payment(message, bot)
 
 
 # Регистрация обработчиков для курсов
@@ -285,20 +235,62 @@ async def successful_payment_gaid(message: Message, bot: Bot, state: FSMContext)
 async def kurs_start(message: Message, bot: Bot):
     await kurs_handler.start(message, bot)
 
-@router.callback_query(F.data.startswith('selectkurs_'))
+@router.callback_query(kb.SelectProduct.filter(F.data_type == 'kurs'))
 @log_user_action
-async def kurs_select(callback: CallbackQuery, state: FSMContext):
-    await kurs_handler.select(callback, state)
+async def kurs_select(callback: CallbackQuery, callback_data: kb.SelectProduct, bot: Bot):
+    await kurs_handler.select(callback, callback_data, bot)
 
-@router.callback_query(F.data.startswith('stars_kurs'))
+@router.callback_query(kb.BuyProduct.filter(F.data_type == 'kurs'))
 @log_user_action
-async def buy_kurs(callback: CallbackQuery, state: FSMContext):
-    await kurs_handler.buy_with_stars(callback, state)
+async def buy_kurs(callback: CallbackQuery, callback_data: kb.BuyProduct):
+    await kurs_handler.buy_with_stars(callback, callback_data)
 
-@router.message(F.successful_payment.invoice_payload == 'kurs')
+@router.message(F.successful_payment.invoice_payload.startswith('invoice:kurs:'))
 @log_user_action
-async def successful_payment_kurs(message: Message, bot: Bot, state: FSMContext):
-    await kurs_handler.successful_payment(message, bot, state)
+async def successful_payment_kurs(message: Message, bot: Bot):
+    await kurs_handler.successful_payment(message, bot)
+
+
+handlers_by_type = {'gaid': gaid_handler, 'kurs': kurs_handler}
+
+
+@router.message(Command(commands='mypurchases'))
+@log_user_action
+async def my_purchases(message: Message):
+    """Повторная загрузка купленных товаров без новой оплаты"""
+    keyboard = await kb.purchases_keyboard(await rq.get_user_purchases(message.from_user.id))
+    if keyboard is None:
+        await message.answer('У вас пока нет покупок')
+        return
+    await message.answer('🛍 Ваши покупки, нажмите, чтобы скачать снова:', reply_markup=keyboard)
+
+
+@router.callback_query(kb.DownloadPurchase.filter())
+@log_user_action
+async def download_purchase(callback: CallbackQuery, callback_data: kb.DownloadPurchase, bot: Bot):
+    if not await rq.has_purchase(callback.from_user.id, callback_data.data_type, callback_data.id):
+        await callback.answer('Этот товар не куплен', show_alert=True)
+        return
+    item = await catalog.get(callback_data.data_type, callback_data.id)
+    if item is None:
+        await callback.answer('Товар больше недоступен', show_alert=True)
+        return
+    await callback.answer()
+    await handlers_by_type[callback_data.data_type].send_file(bot, callback.from_user.id, item)
+
+
+@router.callback_query(kb.CatalogPage.filter())
+async def catalog_page(callback: CallbackQuery, callback_data: kb.CatalogPage):
+    """Листание клавиатуры каталога: и у пользователей, и в админских списках рассылки/удаления"""
+    await callback.answer()
+    keyboard = await kb.catalog_page_keyboard(callback_data.purpose, callback_data.data_type,
+                                              callback_data.cursor, callback_data.direction)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        # Двойное нажатие на ту же страницу
+        if 'message is not modified' not in str(e):
+            raise
 
 
 @router.message(Command(commands=['gaid', 'kurs']))
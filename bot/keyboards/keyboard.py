@@ -1,8 +1,67 @@
+from collections import OrderedDict
+from enum import StrEnum
+from functools import wraps
+
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import (InlineKeyboardMarkup, InlineKeyboardButton)
 
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from database.requests import select_gaid, select_kurs
+from database.catalog import catalog
+from database.requests import get_products_page
+
+# callback_data кнопок несет id товара, а не название: названия бывают с '_'
+# и длиннее лимита Telegram в 64 байта
+class SelectProduct(CallbackData, prefix='select'):
+    data_type: str
+    id: int
+
+
+class SendProduct(CallbackData, prefix='send'):
+    data_type: str
+    id: int
+
+
+class DeleteProduct(CallbackData, prefix='delete'):
+    data_type: str
+    id: int
+
+
+class CatalogPurpose(StrEnum):
+    """Назначение клавиатуры каталога: какую кнопку получает товар"""
+    SELECT = 'select'
+    SEND = 'send'
+    DELETE = 'delete'
+
+
+class CatalogPage(CallbackData, prefix='page'):
+    # Enum: callback с чужим значением не проходит фильтр и не доходит до обработчика
+    purpose: CatalogPurpose
+    data_type: str
+    cursor: int
+    direction: str
+
+
+class BuyProduct(CallbackData, prefix='buy'):
+    data_type: str
+    id: int
+
+
+class DownloadPurchase(CallbackData, prefix='download'):
+    data_type: str
+    id: int
+
+
+class SegmentChoice(CallbackData, prefix='segment'):
+    data_type: str
+    product_id: int
+    code: str
+
+
+class BroadcastAction(CallbackData, prefix='broadcast'):
+    action: str
+    job_id: int
+
 
 admincompkeyboard = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text='Добавить гайд', callback_data='keyboardaddgaid')], [InlineKeyboardButton(text='Добавить курс', callback_data='keyboardaddkurs')], [InlineKeyboardButton(text='Удалить гайд', callback_data='keyboard_delete_gaid')], [InlineKeyboardButton(text='Удалить курс', callback_data='keyboard_delete_kurs')],
@@ -17,59 +76,141 @@ list = InlineKeyboardMarkup(inline_keyboard=[
 ])
 
 
-payment_keyboard_gaid = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text='Оплата ⭐️', callback_data='stars_gaid', pay=True)]
-], resize_keyboard=True)
+# Сколько клавиатур одной функции хранить в кэше. Курсор страницы каталога
+# приходит из callback_data, поэтому поддельные значения не должны раздувать кэш
+KEYBOARD_CACHE_SIZE = 256
+
+
+def per_catalog_version(build):
+    """Клавиатура строится один раз на версию каталога и переиспользуется для всех пользователей.
+
+    Любое изменение товаров поднимает catalog.version, и при следующем
+    вызове клавиатуры собираются заново. Сверх KEYBOARD_CACHE_SIZE
+    вытесняются давно не использованные клавиатуры.
+    """
+    cache = OrderedDict()
+    version = None
+
+    @wraps(build)
+    async def wrapper(*args):
+        nonlocal version
+        current = await catalog.current_version()
+        if current != version:
+            cache.clear()
+            version = current
+        markup = cache.get(args)
+        if markup is None:
+            markup = cache[args] = await build(*args)
+            if len(cache) > KEYBOARD_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(args)
+        return markup
+    return wrapper
+
+
+def broadcast_control_keyboard(job_id: int, paused: bool):
+    toggle = (InlineKeyboardButton(text='▶️ Продолжить', callback_data=BroadcastAction(action='resume', job_id=job_id).pack()) if paused
+              else InlineKeyboardButton(text='⏸ Пауза', callback_data=BroadcastAction(action='pause', job_id=job_id).pack()))
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [toggle, InlineKeyboardButton(text='⛔️ Отменить', callback_data=BroadcastAction(action='cancel', job_id=job_id).pack())]
+    ])
+
+
+# Сегменты аудитории для рассылки товара: код -> текст кнопки
+SEGMENTS = {
+    'all': 'Всем',
+    'vnb': 'Смотрели, но не купили',
+    'nb': 'Еще не купили',
+    'in30': 'Неактивным 30 дней',
+}
+
+
+@per_catalog_version
+async def payment_keyboard(data_type: str, product_id: int, link: str | None = None):
+    """Кнопка оплаты: прямая ссылка на счет или, без нее, запрос счета через BuyProduct"""
+    if link:
+        button = InlineKeyboardButton(text='Оплата ⭐️', url=link)
+    else:
+        button = InlineKeyboardButton(text='Оплата ⭐️', callback_data=BuyProduct(data_type=data_type, id=product_id).pack(), pay=True)
+    return InlineKeyboardMarkup(inline_keyboard=[[button]])
+
+
+async def purchases_keyboard(purchases):
+    """Кнопки скачивания купленных товаров; None, если скачивать нечего"""
+    keyboard = InlineKeyboardBuilder()
+    for data_type, product_id in purchases:
+        item = await catalog.get(data_type, product_id)
+        if item is None:
+            continue
+        keyboard.add(InlineKeyboardButton(text=f"{'📖' if data_type == 'gaid' else '🤓'} {getattr(item, f'name_fail_{data_type}')}",
+                                          callback_data=DownloadPurchase(data_type=data_type, id=product_id).pack()))
+    if not keyboard.export():
+        return None
+    return keyboard.adjust(1).as_markup()
+
+
+@per_catalog_version
+async def segment_keyboard(data_type: str, product_id: int):
+    keyboard = InlineKeyboardBuilder()
+    for code, text in SEGMENTS.items():
+        keyboard.add(InlineKeyboardButton(text=text, callback_data=SegmentChoice(data_type=data_type, product_id=product_id, code=code).pack()))
+    for kurs in await catalog.all('kurs'):
+        if data_type == 'kurs' and kurs.id == product_id:
+            continue
+        keyboard.add(InlineKeyboardButton(text=f'Купившим курс «{kurs.name_fail_kurs}»',
+                                          callback_data=SegmentChoice(data_type=data_type, product_id=product_id, code=f'b{kurs.id}').pack()))
+    return keyboard.adjust(1).as_markup()
+
 
+# Товаров на одной странице клавиатуры каталога
+CATALOG_PAGE_SIZE = 10
 
-payment_keyboard_kurs = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text='Оплата ⭐️', callback_data='stars_kurs', pay=True)]
-], resize_keyboard=True)
+# Кнопка товара на странице каталога в зависимости от назначения клавиатуры
+PRODUCT_BUTTONS = {CatalogPurpose.SELECT: SelectProduct, CatalogPurpose.SEND: SendProduct, CatalogPurpose.DELETE: DeleteProduct}
 
 
-async def selectkeyboardgaid():
-    all_gaid = await select_gaid()
+@per_catalog_version
+async def catalog_page_keyboard(purpose: CatalogPurpose, data_type: str, cursor: int = 0, direction: str = 'next'):
+    items, has_prev, has_next = await get_products_page(data_type, cursor, direction, CATALOG_PAGE_SIZE)
+    button = PRODUCT_BUTTONS[purpose]
     keyboard = InlineKeyboardBuilder()
-    for gaid in all_gaid:
-        keyboard.add(InlineKeyboardButton(text=gaid.name_fail_gaid, callback_data=f"selectgaid_{gaid.name_fail_gaid}"))
-    return keyboard.adjust(2).as_markup()
+    for item in items:
+        keyboard.add(InlineKeyboardButton(text=getattr(item, f'name_fail_{data_type}'),
+                                          callback_data=button(data_type=data_type, id=item.id).pack()))
+    keyboard.adjust(2)
+
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(text='◀️', callback_data=CatalogPage(
+            purpose=purpose, data_type=data_type, cursor=items[0].id, direction='prev').pack()))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text='▶️', callback_data=CatalogPage(
+            purpose=purpose, data_type=data_type, cursor=items[-1].id, direction='next').pack()))
+    if navigation:
+        keyboard.row(*navigation)
+    return keyboard.as_markup()
+
+
+async def selectkeyboardgaid():
+    return await catalog_page_keyboard(CatalogPurpose.SELECT, 'gaid')
 
 
 async def selectkeyboardkurs():
-    all_kurs = await select_kurs()
-    keyboard = InlineKeyboardBuilder()
-    for kurs in all_kurs:
-        keyboard.add(InlineKeyboardButton(text=kurs.name_fail_kurs, callback_data=f"selectkurs_{kurs.name_fail_kurs}"))
-    return keyboard.adjust(2).as_markup()
+    return await catalog_page_keyboard(CatalogPurpose.SELECT, 'kurs')
 
 
 async def sendkeyboardkurs():
-    all_kurs = await select_kurs()
-    keyboard = InlineKeyboardBuilder()
-    for kurs in all_kurs:
-        keyboard.add(InlineKeyboardButton(text=kurs.name_fail_kurs, callback_data=f"sendkurs_{kurs.name_fail_kurs}"))
-    return keyboard.adjust(2).as_markup()
+    return await catalog_page_keyboard(CatalogPurpose.SEND, 'kurs')
 
 
 async def sendkeyboardgaid():
-    all_gaid = await select_gaid()
-    keyboard = InlineKeyboardBuilder()
-    for gaid in all_gaid:
-        keyboard.add(InlineKeyboardButton(text=gaid.name_fail_gaid, callback_data=f"sendgaid_{gaid.name_fail_gaid}"))
-    return keyboard.adjust(2).as_markup()
+    return await catalog_page_keyboard(CatalogPurpose.SEND, 'gaid')
 
 
 async def delit_keyboard_gaid():
-    all_gaid = await select_gaid()
-    keyboard = InlineKeyboardBuilder()
-    for gaid in all_gaid:
-        keyboard.add(InlineKeyboardButton(text=gaid.name_fail_gaid, callback_data=f"delitg_{gaid.name_fail_gaid}"))
-    return keyboard.adjust(2).as_markup()
+    return await catalog_page_keyboard(CatalogPurpose.DELETE, 'gaid')
 
 
 async def delit_keyboard_kurs():
-    all_kurs = await select_kurs()
-    keyboard = InlineKeyboardBuilder()
-    for kurs in all_kurs:
-        keyboard.add(InlineKeyboardButton(text=kurs.name_fail_kurs, callback_data=f"delitk_{kurs.name_fail_kurs}"))
-    return keyboard.adjust(2).as_markup()
+    return await catalog_page_keyboard(CatalogPurpose.DELETE, 'kurs')
@@ -11,20 +11,28 @@ from aiohttp import web
 from aiogram import Bot, Dispatcher, F
 from handlers.starthandler import router
 from database.models import async_main
+from database.catalog import catalog
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import setup_application
 from handlers.starthandler import start
 from utils.commands import set_commands
 from admin.handlerauthadmin import authorization_start
 from admin.handler_add_data import add_gaid, add_data_name, add_data_photo, add_data_description, add_data_file, add_data_price_star, add_kurs
 from admin. handler_delit_data import start_on_delit_gaid, drop_gaid, start_on_delit_kurs, drop_kurs
-from handlers.handler_output_data import gaid_start, gaid_select, buy_gaid, successful_payment_gaid, pre_checkout_query_gaid, kurs_start, kurs_select, buy_kurs, successful_payment_kurs, cancel_any_state
-from admin.sendall import rassilka, kurs, kurssendall, gaids, gaidsendall
-from admin.custom_sendall import function_custom_message, get_custom_message
+from handlers.handler_output_data import gaid_start, gaid_select, buy_gaid, successful_payment_gaid, pre_checkout_query_gaid, kurs_start, kurs_select, buy_kurs, successful_payment_kurs, cancel_any_state, catalog_page, my_purchases, download_purchase
+from admin.sendall import rassilka, kurs, kurssendall, gaids, gaidsendall, segmentsendall, broadcast_control
+from admin.custom_sendall import function_custom_message, get_custom_message, albums
 from utils.file_id_updater import periodic_file_id_update
+from utils.broadcast import resume_broadcast_jobs
+from utils.flood_control import flood_control
+from utils.analytics import views
+from utils.fsm_storage import create_storage, TTLMemoryStorage, FSM_STORAGE, FSM_SWEEP_INTERVAL
+from utils.update_queue import UpdateQueue, QueuedRequestHandler
+from utils.update_dedup import update_dedup
+from utils.invoices import invoice_links
 from admin.statistic import statistica
+from keyboards.keyboard import SelectProduct, SendProduct, DeleteProduct, SegmentChoice, BroadcastAction, CatalogPage, DownloadPurchase, BuyProduct
 
 from aiogram.filters import Command
 from admin.handler_add_data import AddDataStates
@@ -64,26 +72,43 @@ except:
 
 
 bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-
-storage = MemoryStorage()
-
-dp = Dispatcher(storage=storage)
+# Все исходящие запросы проходят через контроль флуда (TelegramRetryAfter / 429)
+bot.session.middleware(flood_control)
+
+storage = create_storage()
+
+# FSM middleware подключается вручную, после очереди апдейтов
+dp = Dispatcher(storage=storage, disable_fsm=True)
+
+# Апдейты обрабатываются в фоне: по порядку для каждого пользователя,
+# параллельно между пользователями. Повторно доставленные Telegram апдейты
+# отбрасываются до FSM: вебхук синхронно проверяет update_id в put() и не
+# занимает повторами место в очереди, а общий Redis проверяет уже в очереди
+# пользователя; при polling очередь и затем дедупликация работают как
+# outer middleware до чтения состояния FSM
+update_queue = UpdateQueue(dp, dedup=update_dedup)
+if FSM_STORAGE == 'redis':
+    # Повтор апдейта может прийти на другую реплику — update_id отмечаются в общем Redis
+    update_dedup.share(storage.redis)
+    # Части одного альбома кастомной рассылки тоже приходят на разные реплики
+    albums.share(storage.redis)
+if IS_WEBHOOK != 1:
+    # Дедупликация — внутри очереди: ожидание Redis не переставит апдейты пользователя
+    dp.update.outer_middleware(update_queue)
+    dp.update.outer_middleware(update_dedup)
+dp.update.outer_middleware(dp.fsm)
 
 
 async def cleanup_old_states():
-    """Очистка старых состояний каждые 6 часов"""
+    """Удаление истекших состояний FSM в памяти каждые FSM_SWEEP_INTERVAL секунд"""
     while True:
         try:
-            # Здесь можно добавить логику очистки, если используешь Redis
-            # или другое хранилище с TTL (time-to-live)
-            logger.debug("Запуск очистки старых состояний...")
-            # Пока просто ждем, если используешь MemoryStorage
-            await asyncio.sleep(6 * 60 * 60)  # 6 часов
+            await asyncio.sleep(FSM_SWEEP_INTERVAL)
+            removed = storage.sweep()
+            logger.debug(f"Очистка старых состояний: удалено {removed}, {storage.stats()}")
         except Exception as e:
             logger.error(f"Ошибка в cleanup_old_states: {e}")
             await asyncio.sleep(60 * 60)  # Ждем час при ошибке
-    # while True:
-    #     await asyncio.sleep(3600)
 
 
 async def send_error_notification(bot: Bot, error: Exception):
@@ -145,31 +170,36 @@ dp.message.register(add_data_file, AddDataStates.file)
 dp.message.register(add_data_price_star, AddDataStates.price_star)
 
 dp.message.register(gaid_start, Command(commands='gaid'))
-dp.callback_query.register(gaid_select, F.data.startswith('selectgaid_'))
-dp.callback_query.register(buy_gaid, F.data.startswith('stars_gaid'))
+dp.callback_query.register(gaid_select, SelectProduct.filter(F.data_type == 'gaid'))
+dp.callback_query.register(buy_gaid, BuyProduct.filter(F.data_type == 'gaid'))
 dp.pre_checkout_query.register(pre_checkout_query_gaid)
-dp.message.register(successful_payment_gaid, F.successful_payment.invoice_payload == 'gaid')
+dp.message.register(successful_payment_gaid, F.successful_payment.invoice_payload.startswith('invoice:gaid:'))
 dp.callback_query.register(start_on_delit_gaid, F.data.startswith('keyboard_delete_gaid'))
-dp.callback_query.register(drop_gaid, F.data.startswith('delitg_'))
+dp.callback_query.register(drop_gaid, DeleteProduct.filter(F.data_type == 'gaid'))
 
 
 dp.callback_query.register(add_kurs, F.data.startswith('keyboardaddkurs'))
 
 
 dp.message.register(kurs_start, Command(commands='kurs'))
-dp.callback_query.register(kurs_select, F.data.startswith('selectkurs_'))
-dp.callback_query.register(buy_kurs, F.data.startswith('stars_kurs'))
-dp.message.register(successful_payment_kurs, F.successful_payment.invoice_payload == 'kurs')
+dp.callback_query.register(kurs_select, SelectProduct.filter(F.data_type == 'kurs'))
+dp.callback_query.register(buy_kurs, BuyProduct.filter(F.data_type == 'kurs'))
+dp.message.register(successful_payment_kurs, F.successful_payment.invoice_payload.startswith('invoice:kurs:'))
 dp.message.register(cancel_any_state, Command(commands=['gaid', 'kurs']))
+dp.callback_query.register(catalog_page, CatalogPage.filter())
+dp.message.register(my_purchases, Command(commands='mypurchases'))
+dp.callback_query.register(download_purchase, DownloadPurchase.filter())
 dp.callback_query.register(start_on_delit_kurs, F.data.startswith('keyboard_delete_kurs'))
-dp.callback_query.register(drop_kurs, F.data.startswith('delitk_'))
+dp.callback_query.register(drop_kurs, DeleteProduct.filter(F.data_type == 'kurs'))
 
 
 dp.callback_query.register(rassilka, F.data.startswith('keyboardrassilka'))
 dp.callback_query.register(kurs, F.data == 'sendkurs')
-dp.callback_query.register(kurssendall, F.data.startswith('sendkurs_'))
+dp.callback_query.register(kurssendall, SendProduct.filter(F.data_type == 'kurs'))
 dp.callback_query.register(gaids, F.data == 'sendgaids')
-dp.callback_query.register(gaidsendall, F.data.startswith('sendgaid_'))
+dp.callback_query.register(gaidsendall, SendProduct.filter(F.data_type == 'gaid'))
+dp.callback_query.register(segmentsendall, SegmentChoice.filter())
+dp.callback_query.register(broadcast_control, BroadcastAction.filter())
 dp.callback_query.register(function_custom_message, F.data == 'custom_message')
 dp.message.register(get_custom_message, Custom_message.msg_custom)
 
@@ -184,37 +214,65 @@ async def healthcheck(request: web.Request) -> web.Response:
     """Endpoint для проверки работоспособности бота"""
     return web.Response(text="OK", status=200)
 
+
+async def metrics(request: web.Request) -> web.Response:
+    """Счетчики очереди апдейтов и кэшей; nginx наружу не проксирует"""
+    return web.json_response({
+        'update_queue': update_queue.stats(),
+        'update_dedup': update_dedup.stats(),
+        'flood_control': flood_control.stats(),
+        'catalog': catalog.stats(),
+        'fsm_storage': storage.stats() if isinstance(storage, TTLMemoryStorage) else {'backend': FSM_STORAGE},
+        'views': views.stats(),
+        'invoice_links': invoice_links.stats(),
+    })
+
     
 async def main() -> None:
     print("Бот запущен! Проверка вебхука...")
     await async_main()
+    await catalog.load()
     await set_commands(bot)
 
     # Запускаем фоновую задачу обновления file_id
     asyncio.create_task(periodic_file_id_update(bot, interval_days=7))
 
-    asyncio.create_task(cleanup_old_states())
+    if isinstance(storage, TTLMemoryStorage):
+        # В Redis истекшие состояния удаляются по TTL ключей
+        asyncio.create_task(cleanup_old_states())
+
+    # Продолжаем рассылки, прерванные перезапуском контейнера или оставшиеся без реплики-владельца
+    asyncio.create_task(resume_broadcast_jobs(bot))
+
+    # Просмотры товаров пишутся в БД пачками
+    asyncio.create_task(views.run())
     
     if IS_WEBHOOK == 1:
         print("Запуск в режиме WEBHOOK...")
 
-        await bot.delete_webhook()
-          
         try:
-            await bot.set_webhook(
-                url=f"{WEBHOOK_HOST}{WEBHOOK_PATH}",
-                drop_pending_updates=True
-            )
-            print(f"Вебхук установлен на {WEBHOOK_HOST}{WEBHOOK_PATH}")
+            # Вебхук ставится, только если он еще не указывает сюда: перезапуск одной
+            # из реплик не должен сбрасывать апдейты, ожидающие остальных (successful_payment)
+            webhook_info = await bot.get_webhook_info()
+            if webhook_info.url != f"{WEBHOOK_HOST}{WEBHOOK_PATH}":
+                await bot.set_webhook(
+                    url=f"{WEBHOOK_HOST}{WEBHOOK_PATH}",
+                    drop_pending_updates=True
+                )
+                print(f"Вебхук установлен на {WEBHOOK_HOST}{WEBHOOK_PATH}")
+            else:
+                print(f"Вебхук уже установлен на {WEBHOOK_HOST}{WEBHOOK_PATH}")
         except Exception as e:
             print(f"Ошибка при установке вебхука: {e}")
             return
 
         app = web.Application()
         app.router.add_get('/health', healthcheck)
-        webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+        app.router.add_get('/metrics', metrics)
+        webhook_requests_handler = QueuedRequestHandler(dispatcher=dp, bot=bot, queue=update_queue)
         webhook_requests_handler.register(app, path=WEBHOOK_PATH)
         setup_application(app, dp, bot=bot)
+        update_queue.start()
         
         runner = web.AppRunner(app)
         await runner.setup()
@@ -231,6 +289,8 @@ async def main() -> None:
             print(f"\nКритическая ошибка: {e}")
         finally:
             print("Останавливаем бота...")
+            await update_queue.stop()
+            await views.flush()
             await bot.session.close()
             await runner.cleanup()
             print("Бот успешно остановлен")
@@ -243,6 +303,7 @@ async def main() -> None:
         except Exception as e:
             print(f"Ошибка при удалении вебхука: {e}")
 
+        update_queue.start()
         try:
             await dp.start_polling(bot)
         except KeyboardInterrupt:
@@ -253,6 +314,8 @@ async def main() -> None:
             raise
         finally:
             print("Останавливаем бота...")
+            await update_queue.stop()
+            await views.flush()
             await bot.session.close()
             await dp.storage.close()
             print("Бот успешно остановлен")
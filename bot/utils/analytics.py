@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+
+import database.requests as rq
+
+logger = logging.getLogger(__name__)
+
+VIEWS_FLUSH_INTERVAL = float(os.getenv('VIEWS_FLUSH_INTERVAL', 5))
+VIEWS_FLUSH_BATCH = int(os.getenv('VIEWS_FLUSH_BATCH', 200))
+# Если БД недоступна, старые просмотры отбрасываются, чтобы буфер не рос бесконечно
+VIEWS_BUFFER_LIMIT = 50000
+
+
+class ViewBuffer:
+    """Просмотры товаров копятся в памяти и пишутся в product_views пачками.
+
+    Обработчик нажатия только добавляет строку в список; запись в БД —
+    одна транзакция с executemany раз в VIEWS_FLUSH_INTERVAL секунд или
+    как только набралось VIEWS_FLUSH_BATCH просмотров.
+    """
+
+    def __init__(self):
+        self._views = []
+        self._flush_task = None
+        self.flushed = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._views)
+
+    def record(self, user_tg_id: int, product_type: str, product_id: int):
+        self._views.append({
+            'user_tg_id': user_tg_id,
+            'product_type': product_type,
+            'product_id': product_id,
+            'viewed_at': datetime.now(timezone.utc).replace(tzinfo=None),
+        })
+        if len(self._views) >= VIEWS_FLUSH_BATCH and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        if not self._views:
+            return
+        batch, self._views = self._views, []
+        try:
+            await rq.add_product_views(batch)
+            self.flushed += len(batch)
+        except Exception as e:
+            logger.error(f"Не удалось записать {len(batch)} просмотров: {e}")
+            self._views = batch + self._views
+            overflow = len(self._views) - VIEWS_BUFFER_LIMIT
+            if overflow > 0:
+                del self._views[:overflow]
+                self.dropped += overflow
+
+    async def run(self):
+        """Фоновая запись по таймеру, запускается из main()"""
+        while True:
+            await asyncio.sleep(VIEWS_FLUSH_INTERVAL)
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {'pending': len(self._views), 'flushed': self.flushed, 'dropped': self.dropped}
+
+
+views = ViewBuffer()
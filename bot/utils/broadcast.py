@@ -0,0 +1,471 @@
+import asyncio
+import logging
+import os
+import secrets
+import socket
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database.requests as rq
+import keyboards.keyboard as kb
+
+logger = logging.getLogger(__name__)
+
+# Telegram пропускает ~30 сообщений в секунду на бота, оставляем небольшой запас
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 28))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 20))
+# Как часто обновляется сообщение с прогрессом у администратора, секунд
+PANEL_INTERVAL = 5
+# Как часто курсор рассылки сохраняется в БД. После рестарта повторно
+# получат сообщение не больше тех, кому отправили за этот интервал.
+CHECKPOINT_INTERVAL = 2
+# Сколько изменений users.active записывается в одной транзакции
+ACTIVE_FLUSH_BATCH = 500
+# Аренда рассылки репликой, секунд: продлевается каждые CHECKPOINT_INTERVAL,
+# а если реплика пропала, рассылку через столько подхватит другая
+BROADCAST_LEASE = int(os.getenv('BROADCAST_LEASE', 30))
+# Имя этого процесса в broadcast_jobs.owner
+REPLICA_ID = f'{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(3)}'
+
+SendFunc = Callable[[Bot, int, dict], Awaitable[object]]
+
+# Виды рассылок: имя -> (функция отправки, сообщений на получателя)
+_job_kinds: dict[str, tuple[SendFunc, int | Callable[[dict], int]]] = {}
+
+
+def job_kind(name: str, cost: int | Callable[[dict], int] = 1):
+    """Регистрирует функцию отправки для вида рассылки.
+
+    По имени вида рассылка восстанавливается из БД после рестарта, поэтому
+    всё, что нужно для отправки, должно лежать в payload. cost — число
+    сообщений на получателя или функция, считающая его по payload.
+    """
+    def decorator(func: SendFunc) -> SendFunc:
+        _job_kinds[name] = (func, cost)
+        return func
+    return decorator
+
+
+class TokenBucket:
+    """Token bucket: не больше rate отправок в секунду с запасом burst"""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def set_rate(self, rate: float):
+        """Меняет скорость, запас burst масштабируется пропорционально"""
+        self.capacity = self.capacity * rate / self.rate
+        self.rate = rate
+        self._tokens = min(self._tokens, self.capacity)
+
+    async def acquire(self, tokens: float = 1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+# Общий лимит на все рассылки бота
+bucket = TokenBucket(BROADCAST_RATE)
+
+
+class Checkpoint:
+    """Курсор рассылки: последний users.id, до которого все получатели обработаны.
+
+    Воркеры завершают отправки не по порядку, поэтому курсор двигается только
+    по непрерывному префиксу подтвержденных получателей. sent и failed
+    считаются по тому же префиксу: получатели за курсором после рестарта
+    будут обработаны заново и не должны попасть в счетчики дважды.
+    """
+
+    def __init__(self, cursor: int, sent: int = 0, failed: int = 0):
+        self.cursor = cursor
+        self.sent = sent
+        self.failed = failed
+        self._pending = deque()
+        self._confirmed: dict[int, bool] = {}
+
+    def dispatched(self, user_id: int):
+        self._pending.append(user_id)
+
+    def confirm(self, user_id: int, sent: bool):
+        self._confirmed[user_id] = sent
+        while self._pending and self._pending[0] in self._confirmed:
+            self.cursor = self._pending.popleft()
+            if self._confirmed.pop(self.cursor):
+                self.sent += 1
+            else:
+                self.failed += 1
+
+
+class ActiveStatusBuffer:
+    """Отложенная запись users.active: изменения копятся в памяти и пишутся пачками"""
+
+    def __init__(self, batch_size: int = ACTIVE_FLUSH_BATCH):
+        self.batch_size = batch_size
+        self._changes: dict[int, int] = {}
+
+    def set(self, tg_id: int, active: int):
+        self._changes[tg_id] = active
+
+    def __len__(self):
+        return len(self._changes)
+
+    async def flush(self):
+        changes, self._changes = self._changes, {}
+        items = list(changes.items())
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            try:
+                await rq.set_active_many(batch)
+            except Exception:
+                # Возвращаем незаписанное в буфер, не затирая более свежие значения
+                for tg_id, active in items[start:]:
+                    self._changes.setdefault(tg_id, active)
+                raise
+
+
+class BroadcastStats:
+    def __init__(self, total: int, sent: int = 0, failed: int = 0):
+        self.total = total
+        self.sent = sent
+        self.failed = failed
+        self.requeued = 0
+        self._done_before = sent + failed
+        self.started_at = time.monotonic()
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """Скорость отправки, получателей в секунду"""
+        elapsed = self.elapsed
+        return (self.done - self._done_before) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        """Оценка оставшегося времени в секундах"""
+        rate = self.rate
+        if rate <= 0:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def summary(self) -> str:
+        eta = self.eta
+        eta_text = f'{eta:.0f} с' if eta is not None else '—'
+        return (f'{self.done}/{self.total} (успешно {self.sent}, ошибок {self.failed}, повторов после 429 {self.requeued}), '
+                f'{self.rate:.1f} польз./с, осталось ~{eta_text}')
+
+
+class Broadcast:
+    """Рассылка через пул воркеров под общим ограничением скорости"""
+
+    def __init__(self, bot: Bot, job, workers: int = BROADCAST_WORKERS):
+        self.bot = bot
+        self.job_id = job.id
+        self.payload = job.payload
+        self.admin_chat_id = job.admin_chat_id
+        self.send, cost = _job_kinds[job.kind]
+        self.cost = cost(job.payload) if callable(cost) else cost
+        # Получатели сегмента читаются из БД постранично, начиная с курсора задания
+        self.users = rq.iter_active_users(after_id=job.cursor, segment=job.payload.get('segment'))
+        self.workers = workers
+        self.checkpoint = Checkpoint(job.cursor, job.sent, job.failed)
+        self.active_buffer = ActiveStatusBuffer()
+        self.stats = BroadcastStats(job.total, job.sent, job.failed)
+        self.status = job.status
+        self.cancelled = False
+        # Аренду забрала другая реплика: рассылка останавливается здесь без записи в БД
+        self.owner = REPLICA_ID
+        self.lease_lost = False
+        self._unpaused = asyncio.Event()
+        if self.status != 'paused':
+            self._unpaused.set()
+        self._panel_message_id = None
+        self._panel_text = None
+
+    def pause(self):
+        self.status = 'paused'
+        self._unpaused.clear()
+
+    def resume(self):
+        self.status = 'running'
+        self._unpaused.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.status = 'cancelled'
+        # Воркеры на паузе должны проснуться, чтобы увидеть отмену
+        self._unpaused.set()
+
+    def apply(self, action: str):
+        """Кнопка панели: pause, resume или cancel"""
+        {'pause': self.pause, 'resume': self.resume, 'cancel': self.cancel}[action]()
+
+    def _lose_lease(self):
+        logger.warning(f"Рассылку #{self.job_id} ведет другая реплика, здесь она остановлена")
+        self.lease_lost = True
+        self.cancelled = True
+        self._unpaused.set()
+
+    async def _deliver(self, user) -> bool | None:
+        """Отправляет сообщение одному получателю.
+
+        True — доставлено, False — не доставлено, None — нужно повторить позже.
+        """
+        try:
+            await self.send(self.bot, user.tg_id, self.payload)
+            self.stats.sent += 1
+            return True
+        except TelegramRetryAfter:
+            # Flood control уже выдержал паузу, отправка просто встает в очередь заново
+            self.stats.requeued += 1
+            return None
+        except TelegramForbiddenError:
+            # Бот заблокирован или аккаунт удален
+            self.active_buffer.set(user.tg_id, 0)
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e):
+                self.active_buffer.set(user.tg_id, 0)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке пользователю {user.tg_id}: {e}")
+        self.stats.failed += 1
+        return False
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            user = await queue.get()
+            try:
+                delivered = None
+                while delivered is None:
+                    await self._unpaused.wait()
+                    if self.cancelled:
+                        break
+                    # По токену на сообщение: cost может быть больше запаса bucket
+                    for _ in range(self.cost):
+                        await bucket.acquire()
+                    delivered = await self._deliver(user)
+                if delivered is not None:
+                    self.checkpoint.confirm(user.id, delivered)
+            finally:
+                queue.task_done()
+
+    def panel_text(self) -> str:
+        stats = self.stats
+        eta = stats.eta
+        status_text = {
+            'running': '▶️ идет',
+            'paused': '⏸ на паузе',
+            'cancelled': '⛔️ отменена',
+            'done': '✅ завершена',
+            'failed': '❌ прервана из-за ошибки',
+        }[self.status]
+        text = (f'📨 Рассылка #{self.job_id}: {status_text}\n\n'
+                f'Отправлено: {stats.sent}\n'
+                f'Не доставлено: {stats.failed}\n'
+                f'Осталось: {max(stats.total - stats.done, 0)}\n'
+                f'Скорость: {stats.rate:.1f} польз./с')
+        if self.status == 'running' and eta is not None:
+            text += f'\nДо окончания: ~{eta:.0f} с'
+        return text
+
+    async def update_panel(self):
+        """Публикует или редактирует сообщение с прогрессом у администратора"""
+        text = self.panel_text()
+        if text == self._panel_text or self.lease_lost:
+            return
+        finished = self.status in ('done', 'cancelled', 'failed')
+        reply_markup = None if finished else kb.broadcast_control_keyboard(self.job_id, self.status == 'paused')
+        try:
+            if self._panel_message_id is None:
+                message = await self.bot.send_message(self.admin_chat_id, text=text, reply_markup=reply_markup)
+                self._panel_message_id = message.message_id
+            else:
+                await self.bot.edit_message_text(text=text, chat_id=self.admin_chat_id,
+                                                 message_id=self._panel_message_id, reply_markup=reply_markup)
+            self._panel_text = text
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logger.error(f"Не удалось обновить прогресс рассылки #{self.job_id}: {e}")
+        except Exception as e:
+            logger.error(f"Не удалось обновить прогресс рассылки #{self.job_id}: {e}")
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(PANEL_INTERVAL)
+            logger.info(f"Рассылка #{self.job_id}: {self.stats.summary()}")
+            await self.update_panel()
+
+    async def _save_checkpoint(self, release: bool = False):
+        """Сохраняет курсор и продлевает аренду; release=True отдает рассылку другим репликам"""
+        # Курсор фиксируется до записи статусов: всё, что он покрывает, уже лежит в буфере.
+        # Счетчики — по тому же префиксу, иначе после рестарта done может превысить total
+        checkpoint = self.checkpoint
+        cursor, sent, failed = checkpoint.cursor, checkpoint.sent, checkpoint.failed
+        await self.active_buffer.flush()
+        if self.lease_lost:
+            return
+        owned = await rq.save_broadcast_checkpoint(self.job_id, cursor, sent, failed, self.status,
+                                                   owner=self.owner, lease_seconds=0 if release else BROADCAST_LEASE,
+                                                   total=self.stats.total)
+        if not owned:
+            self._lose_lease()
+
+    async def _checkpointer(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            try:
+                await self._save_checkpoint()
+                # Кнопки панели, нажатые на другой реплике, приходят через БД
+                action = None if self.lease_lost else await rq.take_broadcast_control(self.job_id, self.owner)
+                if action is not None and not self.cancelled:
+                    self.apply(action)
+                    await self.update_panel()
+            except Exception as e:
+                logger.error(f"Не удалось сохранить курсор рассылки #{self.job_id}: {e}")
+
+    async def run(self) -> BroadcastStats:
+        _active[self.job_id] = self
+        await self.update_panel()
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        tasks = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        background = [asyncio.create_task(self._report_progress()), asyncio.create_task(self._checkpointer())]
+        try:
+            async for user in self.users:
+                if self.cancelled:
+                    break
+                self.checkpoint.dispatched(user.id)
+                await queue.put(user)
+            await queue.join()
+        except asyncio.CancelledError:
+            # Остановка бота: задание остается в БД, его продолжит другая реплика или этот бот после рестарта
+            await self._save_checkpoint(release=True)
+            raise
+        except Exception:
+            self.status = 'failed'
+            await self._save_checkpoint(release=True)
+            await self.update_panel()
+            raise
+        finally:
+            _active.pop(self.job_id, None)
+            for task in background + tasks:
+                task.cancel()
+            await asyncio.gather(*background, *tasks, return_exceptions=True)
+        if self.lease_lost:
+            return self.stats
+        if not self.cancelled:
+            self.status = 'done'
+            # Получатели за курсором, отключенные другой рассылкой, в выборку не попали,
+            # а новые /start попали: итог — это все, кого рассылка обработала
+            self.stats.total = self.stats.done
+        await self._save_checkpoint(release=True)
+        await self.update_panel()
+        logger.info(f"Рассылка #{self.job_id} завершена за {self.stats.elapsed:.1f} с: {self.stats.summary()}")
+        return self.stats
+
+
+# Ссылки на запущенные рассылки, чтобы задачи не собрал сборщик мусора
+_running: set[asyncio.Task] = set()
+# Идущие рассылки по id задания — для кнопок паузы и отмены
+_active: dict[int, Broadcast] = {}
+
+
+def get_active_broadcast(job_id: int) -> Broadcast | None:
+    return _active.get(job_id)
+
+
+async def _run_and_report(broadcast: Broadcast):
+    try:
+        stats = await broadcast.run()
+    except Exception as e:
+        logger.exception(f"Рассылка #{broadcast.job_id} прервана из-за ошибки")
+        await broadcast.bot.send_message(broadcast.admin_chat_id, text=f'Рассылка прервана из-за ошибки: {e}')
+        return
+    if broadcast.lease_lost:
+        # Итог сообщит реплика, которая довела рассылку до конца
+        return
+
+    if broadcast.cancelled:
+        text = f'Рассылка отменена. Отправлено {stats.sent} пользователям. Не удалось отправить {stats.failed} пользователям.'
+    elif stats.sent > 0:
+        text = f'Успешная рассылка. Отправлено {stats.sent} пользователям. Не удалось отправить {stats.failed} пользователям.'
+    else:
+        text = f'Не успешная рассылка. Не удалось отправить {stats.failed} пользователям.'
+    text += f'\nВремя: {stats.elapsed:.0f} с, скорость: {stats.rate:.1f} польз./с, повторов после 429: {stats.requeued}.'
+    await broadcast.bot.send_message(broadcast.admin_chat_id, text=text)
+
+
+def _launch(broadcast: Broadcast):
+    task = asyncio.create_task(_run_and_report(broadcast))
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+
+
+async def start_broadcast(bot: Bot, kind: str, payload: dict, admin_chat_id: int) -> Broadcast:
+    """Сохраняет задание рассылки в БД и запускает его в фоне"""
+    total = await rq.count_active_users(segment=payload.get('segment'))
+    job_id = await rq.create_broadcast_job(kind, payload, admin_chat_id, total,
+                                           owner=REPLICA_ID, lease_seconds=BROADCAST_LEASE)
+    job = await rq.get_broadcast_job(job_id)
+    broadcast = Broadcast(bot, job)
+    _launch(broadcast)
+    return broadcast
+
+
+async def resume_broadcast_jobs(bot: Bot):
+    """Продолжает незавершенные рассылки с последнего подтвержденного получателя.
+
+    Работает все время: каждые BROADCAST_LEASE секунд забирает рассылки,
+    у которых нет владельца или истекла аренда (реплика перезапущена или
+    пропала). claim_broadcast_job атомарен, поэтому при нескольких
+    репликах рассылку продолжит только одна.
+    """
+    while True:
+        try:
+            await _resume_unowned_jobs(bot)
+        except Exception as e:
+            logger.error(f"Ошибка при возобновлении рассылок: {e}")
+        await asyncio.sleep(BROADCAST_LEASE)
+
+
+async def _resume_unowned_jobs(bot: Bot):
+    for job in await rq.get_unfinished_broadcast_jobs():
+        if job.id in _active:
+            continue
+        if job.kind not in _job_kinds:
+            logger.error(f"Неизвестный вид рассылки #{job.id}: {job.kind}")
+            await rq.save_broadcast_checkpoint(job.id, job.cursor, job.sent, job.failed, 'failed')
+            continue
+        if not await rq.claim_broadcast_job(job.id, REPLICA_ID, BROADCAST_LEASE):
+            continue
+        # Курсор перечитывается после захвата: прежний владелец мог успеть его сдвинуть
+        job = await rq.get_broadcast_job(job.id)
+        # Пока рассылка стояла, часть получателей за курсором могла стать неактивной
+        job.total = job.sent + job.failed + await rq.count_active_users(after_id=job.cursor,
+                                                                        segment=job.payload.get('segment'))
+        broadcast = Broadcast(bot, job)
+        logger.info(f"Возобновление рассылки #{job.id} с users.id > {job.cursor}")
+        try:
+            await bot.send_message(job.admin_chat_id, text=f'Рассылка #{job.id} возобновлена после перезапуска.')
+        except Exception as e:
+            logger.error(f"Не удалось уведомить администратора о рассылке #{job.id}: {e}")
+        _launch(broadcast)
@@ -15,6 +15,10 @@ async def set_commands(bot: Bot):
         BotCommand(
             command='kurs',
             description='Курсы🤓'
+        ),
+        BotCommand(
+            command='mypurchases',
+            description='Мои покупки🛍'
         )
     ]
 
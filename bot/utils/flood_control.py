@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from utils.broadcast import TokenBucket, bucket
+
+logger = logging.getLogger(__name__)
+
+FLOOD_MAX_RETRIES = int(os.getenv('FLOOD_MAX_RETRIES', 3))
+# Во сколько раз снижается скорость рассылок после 429
+FLOOD_RATE_DECREASE = 0.5
+FLOOD_MIN_RATE = 1.0
+# Каждые FLOOD_RECOVERY_INTERVAL секунд без 429 скорость растет на FLOOD_RECOVERY_STEP от исходной
+FLOOD_RECOVERY_INTERVAL = 10
+FLOOD_RECOVERY_STEP = 0.1
+# Пауза после 429 задерживает только отправку сообщений. Ответы на нажатия,
+# pre_checkout_query и правки сообщений идут сразу: Telegram отменяет оплату,
+# если pre_checkout_query не подтвержден примерно за 10 секунд
+PACED_METHOD_PREFIXES = ('send', 'copy', 'forward')
+
+
+class FloodControl(BaseRequestMiddleware):
+    """Адаптивный контроль флуда для всех запросов к Bot API.
+
+    При TelegramRetryAfter отправка сообщений (send*, copy*, forward*)
+    ставится на паузу на retry_after секунд, запрос повторяется, а скорость
+    рассылок (token bucket) снижается. Остальные методы паузу не ждут и при
+    429 не повторяются. После спокойного периода скорость постепенно
+    возвращается к исходной.
+    """
+
+    def __init__(self, limiter: TokenBucket, max_retries: int = FLOOD_MAX_RETRIES):
+        self.limiter = limiter
+        self.max_rate = limiter.rate
+        self.max_retries = max_retries
+        self.retry_after_count = 0
+        self.wait_time = 0.0
+        self._resume_at = 0.0
+        self._last_change = time.monotonic()
+
+    async def _wait(self):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _on_flood(self, retry_after: int):
+        now = time.monotonic()
+        self.retry_after_count += 1
+        self._last_change = now
+        resume_at = max(self._resume_at, now + retry_after)
+        # wait_time — реальная длительность пауз, а не сумма ожиданий всех воркеров
+        self.wait_time += resume_at - max(self._resume_at, now)
+        if now < self._resume_at:
+            # Параллельные запросы получили 429 в ту же паузу — скорость уже снижена
+            self._resume_at = resume_at
+            return
+        self._resume_at = resume_at
+        self.limiter.set_rate(max(FLOOD_MIN_RATE, self.limiter.rate * FLOOD_RATE_DECREASE))
+        logger.warning(f"Flood control: пауза {retry_after} с, скорость рассылок снижена до {self.limiter.rate:.1f} сообщ./с")
+
+    def _recover(self):
+        now = time.monotonic()
+        if self.limiter.rate < self.max_rate and now - self._last_change >= FLOOD_RECOVERY_INTERVAL:
+            self.limiter.set_rate(min(self.max_rate, self.limiter.rate + self.max_rate * FLOOD_RECOVERY_STEP))
+            self._last_change = now
+
+    async def __call__(self, make_request, bot, method):
+        if not method.__api_method__.startswith(PACED_METHOD_PREFIXES):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self._on_flood(e.retry_after)
+                raise
+        attempt = 0
+        while True:
+            await self._wait()
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self._on_flood(e.retry_after)
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                continue
+            self._recover()
+            return response
+
+    def stats(self) -> dict:
+        return {
+            'retry_after_count': self.retry_after_count,
+            'wait_time': round(self.wait_time, 1),
+            'broadcast_rate': round(self.limiter.rate, 1),
+        }
+
+
+flood_control = FloodControl(bucket)
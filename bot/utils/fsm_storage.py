@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+# Брошенный диалог (админ не дописал товар, пользователь не закончил ввод) живет сутки
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 24 * 60 * 60))
+FSM_MAX_KEYS = int(os.getenv('FSM_MAX_KEYS', 100000))
+FSM_MAX_BYTES = int(os.getenv('FSM_MAX_BYTES', 64 * 1024 * 1024))
+FSM_SWEEP_INTERVAL = int(os.getenv('FSM_SWEEP_INTERVAL', 10 * 60))
+# memory — TTLMemoryStorage в процессе; redis — RedisStorage aiogram, общее для нескольких реплик бота
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'memory')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+
+# Примерные накладные расходы на запись: ключ, dataclass, место в OrderedDict
+RECORD_OVERHEAD = 300
+
+
+@dataclass
+class TTLRecord:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    expires_at: float = 0.0
+    size: int = 0
+
+
+class TTLMemoryStorage(BaseStorage):
+    """FSM в памяти с TTL, LRU-вытеснением и ограничением по памяти.
+
+    В отличие от MemoryStorage, чтение не создает записей, пустые записи
+    (без состояния и данных) удаляются, а каждая запись истекает через ttl
+    секунд после последнего обращения. При превышении max_keys или max_bytes
+    вытесняются давно не использованные ключи. Истекшие записи удаляются
+    при обращении и периодически в sweep().
+    """
+
+    def __init__(self, ttl: int = FSM_STATE_TTL, max_keys: int = FSM_MAX_KEYS, max_bytes: int = FSM_MAX_BYTES):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+        self._records: OrderedDict[StorageKey, TTLRecord] = OrderedDict()
+        self._bytes = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(record: TTLRecord) -> int:
+        return RECORD_OVERHEAD + len(record.state or '') + len(json.dumps(record.data, ensure_ascii=False, default=str))
+
+    def _get(self, key: StorageKey) -> Optional[TTLRecord]:
+        record = self._records.get(key)
+        if record is None:
+            return None
+        now = time.monotonic()
+        if record.expires_at <= now:
+            self._delete(key)
+            self.expired += 1
+            return None
+        record.expires_at = now + self.ttl
+        self._records.move_to_end(key)
+        return record
+
+    def _delete(self, key: StorageKey):
+        record = self._records.pop(key)
+        self._bytes -= record.size
+
+    def _put(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]):
+        if key in self._records:
+            self._delete(key)
+        if state is None and not data:
+            return
+        record = TTLRecord(state=state, data=data, expires_at=time.monotonic() + self.ttl)
+        record.size = self._size(record)
+        self._records[key] = record
+        self._bytes += record.size
+        while self._records and (len(self._records) > self.max_keys or self._bytes > self.max_bytes):
+            oldest = next(iter(self._records))
+            self._delete(oldest)
+            self.evictions += 1
+            if oldest == key:
+                logger.warning(f"Данные FSM для {key.chat_id} больше лимита {self.max_bytes} байт и не сохранены")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get(key)
+        self._put(key, state.state if isinstance(state, State) else state, record.data if record else {})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._get(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._get(key)
+        self._put(key, record.state if record else None, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._get(key)
+        return record.data.copy() if record else {}
+
+    def sweep(self) -> int:
+        """Удаляет истекшие записи, возвращает их число.
+
+        Записи лежат в порядке последнего обращения, а значит и в порядке
+        истечения, поэтому проход останавливается на первой живой записи.
+        """
+        now = time.monotonic()
+        removed = 0
+        while self._records:
+            key, record = next(iter(self._records.items()))
+            if record.expires_at > now:
+                break
+            self._delete(key)
+            removed += 1
+        self.expired += removed
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            'backend': 'memory',
+            'keys': len(self._records),
+            'bytes': self._bytes,
+            'expired': self.expired,
+            'evictions': self.evictions,
+        }
+
+    async def close(self) -> None:
+        self._records.clear()
+        self._bytes = 0
+
+
+def create_storage() -> BaseStorage:
+    """Хранилище FSM по настройке FSM_STORAGE из .env"""
+    if FSM_STORAGE == 'redis':
+        logger.info(f"FSM хранится в Redis: {REDIS_URL}")
+        # redis нужен только при FSM_STORAGE=redis; брошенные диалоги Redis удаляет сам по TTL
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    if FSM_STORAGE != 'memory':
+        raise ValueError(f"Неизвестное значение FSM_STORAGE: {FSM_STORAGE}")
+    return TTLMemoryStorage()
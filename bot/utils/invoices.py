@@ -0,0 +1,69 @@
+import logging
+import secrets
+
+from aiogram import Bot
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import LabeledPrice
+
+logger = logging.getLogger(__name__)
+
+
+# payload счета: товар и nonce счета. Оплата и выдача файла не зависят от FSM,
+# который теряется при перезапуске и перезаписывается при выборе другого товара
+class InvoicePayload(CallbackData, prefix='invoice'):
+    data_type: str
+    id: int
+    nonce: str
+
+
+def parse_invoice_payload(payload: str) -> InvoicePayload | None:
+    try:
+        return InvoicePayload.unpack(payload)
+    except (TypeError, ValueError):
+        # Счета старого формата ('gaid'/'kurs') или чужие
+        return None
+
+
+def invoice_fields(data_type: str, item) -> dict:
+    return {
+        'title': getattr(item, f'name_fail_{data_type}'),
+        'description': getattr(item, f'description_{data_type}'),
+        'provider_token': '',
+        'currency': 'XTR',
+        'payload': InvoicePayload(data_type=data_type, id=item.id, nonce=secrets.token_hex(4)).pack(),
+        'prices': [LabeledPrice(label='XTR', amount=getattr(item, f'price_star_{data_type}'))],
+    }
+
+
+class InvoiceLinks:
+    """Кэш ссылок createInvoiceLink по товару.
+
+    Ссылка не привязана к пользователю, поэтому одна на товар: карточка
+    сразу несет кнопку оплаты, и покупка обходится без answer_invoice.
+    Ссылка создается заново, только если у товара изменились название,
+    описание или цена.
+    """
+
+    def __init__(self):
+        self._links = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, bot: Bot, data_type: str, item) -> str:
+        fingerprint = (getattr(item, f'name_fail_{data_type}'), getattr(item, f'description_{data_type}'),
+                       getattr(item, f'price_star_{data_type}'))
+        cached = self._links.get((data_type, item.id))
+        if cached is not None and cached[0] == fingerprint:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        link = await bot.create_invoice_link(**invoice_fields(data_type, item))
+        self._links[(data_type, item.id)] = (fingerprint, link)
+        logger.info(f"Создана ссылка на оплату {data_type} #{item.id}")
+        return link
+
+    def stats(self) -> dict:
+        return {'links': len(self._links), 'hits': self.hits, 'misses': self.misses}
+
+
+invoice_links = InvoiceLinks()
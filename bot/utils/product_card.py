@@ -0,0 +1,56 @@
+from aiogram import Bot, html
+from aiogram.types import InlineKeyboardMarkup
+
+# Лимит подписи к медиа в Telegram
+CAPTION_LIMIT = 1024
+
+TITLES = {'gaid': 'Гайд:', 'kurs': 'Курс:'}
+
+
+def card_caption(data_type: str, name: str, description: str, price=None) -> str:
+    caption = (f'{html.bold(TITLES[data_type])} {html.quote(name)}\n\n'
+               f'{html.bold("Описание:")} {html.quote(description)}')
+    if price is not None:
+        caption += f'\n\n\n{html.bold("Стоимость в звездах:")} {price}'
+    return caption
+
+
+async def send_product_card(bot: Bot, chat_id: int, data_type: str, name: str, photo: str, description: str,
+                            price, reply_markup: InlineKeyboardMarkup | None = None):
+    """Карточка товара одним сообщением: фото, подпись с описанием и ценой, клавиатура"""
+    caption = card_caption(data_type, name, description, price)
+    if len(caption) <= CAPTION_LIMIT:
+        return await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, reply_markup=reply_markup)
+    # Слишком длинное описание не влезает в подпись — прежний вид из двух сообщений
+    await bot.send_photo(chat_id=chat_id, photo=photo)
+    return await bot.send_message(chat_id=chat_id, text=caption, reply_markup=reply_markup)
+
+
+def fit_caption(data_type: str, name: str, description: str, price=None) -> str:
+    """Подпись карточки в пределах CAPTION_LIMIT: длинное описание обрезается с многоточием"""
+    caption = card_caption(data_type, name, description, price)
+    if len(caption) <= CAPTION_LIMIT:
+        return caption
+    # Экранирование меняет длину, поэтому самый длинный подходящий префикс ищем бинарным поиском
+    low, high = 0, len(description)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if len(card_caption(data_type, name, description[:middle] + '…', price)) <= CAPTION_LIMIT:
+            low = middle
+        else:
+            high = middle - 1
+    return card_caption(data_type, name, description[:low] + '…', price)
+
+
+async def send_product_file(bot: Bot, chat_id: int, data_type: str, name: str, photo: str, description: str, file: str):
+    """Товар вместе с файлом для рассылки: фото с карточкой, затем документ.
+
+    Telegram не собирает фото и документ в один альбом, поэтому это два
+    запроса на получателя (см. PRODUCT_FILE_COST).
+    """
+    await bot.send_photo(chat_id=chat_id, photo=photo, caption=fit_caption(data_type, name, description))
+    return await bot.send_document(chat_id=chat_id, document=file, caption=html.quote(name))
+
+
+# Сообщений на один товар в send_product_file — для token bucket рассылок
+PRODUCT_FILE_COST = 2
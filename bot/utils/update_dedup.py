@@ -0,0 +1,100 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+# Telegram повторяет доставку апдейта, пока не получит ответ; повтор позже окна не отсекается
+UPDATE_DEDUP_WINDOW = int(os.getenv('UPDATE_DEDUP_WINDOW', 60 * 60))
+UPDATE_DEDUP_MAX_IDS = int(os.getenv('UPDATE_DEDUP_MAX_IDS', 100000))
+
+
+class UpdateDeduplicator(BaseMiddleware):
+    """Outer middleware на dp.update, отбрасывающий повторно доставленные апдейты.
+
+    Повтор вебхука мог бы второй раз выдать файл после successful_payment
+    или запустить рассылку. update_id хранятся в OrderedDict в порядке
+    получения: проверка — O(1), а устаревшие и лишние сверх max_ids
+    записи снимаются с начала.
+
+    Несколько реплик за nginx получают повторы одного апдейта в разные
+    процессы, поэтому после share(redis) новый update_id дополнительно
+    отмечается в Redis (SET NX с TTL окна) — общем для всех реплик. Запрос
+    к Redis делается уже в очереди пользователя (UpdateQueue), чтобы его
+    ожидание не переставляло апдейты одного пользователя.
+    """
+
+    def __init__(self, window: int = UPDATE_DEDUP_WINDOW, max_ids: int = UPDATE_DEDUP_MAX_IDS):
+        self.window = window
+        self.max_ids = max_ids
+        self._seen: OrderedDict[int, float] = OrderedDict()
+        self.redis = None
+        self.suppressed = 0
+
+    def share(self, redis):
+        """Проверять update_id и в Redis, общем для всех реплик бота"""
+        self.redis = redis
+
+    @staticmethod
+    def _redis_key(update_id: int) -> str:
+        return f'update_dedup:{update_id}'
+
+    def _trim(self, now: float):
+        while self._seen:
+            update_id, seen_at = next(iter(self._seen.items()))
+            if len(self._seen) < self.max_ids and now - seen_at <= self.window:
+                break
+            del self._seen[update_id]
+
+    def seen(self, update_id: int) -> bool:
+        """Запоминает update_id в процессе; True, если он уже был в окне.
+
+        Проверка синхронная, поэтому апдейты встают в очередь в порядке получения.
+        """
+        now = time.monotonic()
+        self._trim(now)
+        if update_id in self._seen:
+            self.suppressed += 1
+            return True
+        self._seen[update_id] = now
+        return False
+
+    async def seen_shared(self, update_id: int) -> bool:
+        """Отмечает update_id в Redis; True, если его уже приняла другая реплика"""
+        if self.redis is None:
+            return False
+        try:
+            first = await self.redis.set(self._redis_key(update_id), 1, nx=True, ex=self.window)
+        except Exception as e:
+            # Без Redis лучше обработать возможный повтор, чем потерять апдейт
+            logger.error(f"Не удалось проверить апдейт {update_id} в Redis: {e}")
+            return False
+        if not first:
+            self.suppressed += 1
+            return True
+        return False
+
+    async def is_duplicate(self, update_id: int) -> bool:
+        """Запоминает update_id; True, если он уже был в окне здесь или на другой реплике"""
+        return self.seen(update_id) or await self.seen_shared(update_id)
+
+    def forget(self, update_id: int):
+        """Убирает update_id, если апдейт так и не был принят в очередь"""
+        self._seen.pop(update_id, None)
+
+    async def __call__(self, handler, event: Update, data: dict):
+        if await self.is_duplicate(event.update_id):
+            logger.info(f"Повторный апдейт {event.update_id} пропущен")
+            return UNHANDLED
+        return await handler(event, data)
+
+    def stats(self) -> dict:
+        return {'tracked': len(self._seen), 'suppressed': self.suppressed}
+
+
+update_dedup = UpdateDeduplicator()
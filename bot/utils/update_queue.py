@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from aiogram.types.update import UpdateTypeLookupError
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+from utils.update_dedup import UpdateDeduplicator
+
+logger = logging.getLogger(__name__)
+
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+# Сколько апдейтов (разных пользователей) обрабатывается одновременно
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 8))
+# Заголовок Retry-After для ответа 503, когда очередь заполнена
+UPDATE_RETRY_AFTER = int(os.getenv('UPDATE_RETRY_AFTER', 5))
+# Сколько секунд при остановке ждем, пока воркеры разберут очередь
+UPDATE_DRAIN_TIMEOUT = 10
+# Окно последних ожиданий в очереди для p50/p95
+WAIT_WINDOW = 1000
+
+
+def update_key(update: Update) -> Hashable:
+    """Ключ очередности апдейта: пользователь, иначе чат.
+
+    Апдейты без пользователя и чата получают собственный ключ
+    и обрабатываются без ожидания других.
+    """
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        event = None
+    user = getattr(event, 'from_user', None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, 'chat', None)
+    if chat is not None:
+        return ('chat', chat.id)
+    return ('update', update.update_id)
+
+
+class UpdateQueue(BaseMiddleware):
+    """Ограниченная очередь апдейтов: по порядку для пользователя, параллельно между пользователями.
+
+    У каждого пользователя своя очередь, которую разбирает отдельная задача,
+    поэтому шаги FSM одного пользователя (AddDataStates.name, затем photo)
+    не переставляются, а разные пользователи не ждут друг друга. Одновременно
+    обрабатывается не больше workers апдейтов.
+
+    Вебхук кладет апдейт через put() и сразу отвечает Telegram, поэтому
+    долгая рассылка или скачивание файла не задерживают ответ. Если в
+    очередях уже maxsize апдейтов, put() возвращает False, и вебхук отвечает
+    503 — Telegram повторит позже. Повторы уже принятых апдейтов (dedup)
+    подтверждаются без постановки в очередь; повторы, принятые другой
+    репликой, отсекаются по Redis уже в очереди пользователя. При polling
+    тот же порядок дает outer middleware на dp.update (см. __call__).
+    """
+
+    def __init__(self, dispatcher: Dispatcher, maxsize: int = UPDATE_QUEUE_SIZE, workers: int = UPDATE_WORKERS,
+                 dedup: UpdateDeduplicator | None = None):
+        self.dispatcher = dispatcher
+        self.dedup = dedup
+        self.maxsize = maxsize
+        self.workers = workers
+        self._queues: dict[Hashable, deque] = {}
+        self._drainers: set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(workers)
+        self._pending = 0
+        self._closing = False
+        self._waits = deque(maxlen=WAIT_WINDOW)
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.wait_max = 0.0
+
+    def submit(self, key: Hashable, job: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """Ставит job в очередь ключа key; результат — в возвращаемом future"""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            task = asyncio.create_task(self._drain(key, queue))
+            self._drainers.add(task)
+            task.add_done_callback(self._drainers.discard)
+        queue.append((time.monotonic(), job, future))
+        self._pending += 1
+        return future
+
+    async def _drain(self, key: Hashable, queue: deque):
+        try:
+            while queue:
+                enqueued_at, job, future = queue.popleft()
+                async with self._slots:
+                    wait = time.monotonic() - enqueued_at
+                    self._waits.append(wait)
+                    self.wait_max = max(self.wait_max, wait)
+                    try:
+                        result = await job()
+                        self.processed += 1
+                        if not future.done():
+                            future.set_result(result)
+                    except Exception as e:
+                        self.failed += 1
+                        if not future.done():
+                            future.set_exception(e)
+                    finally:
+                        self._pending -= 1
+        finally:
+            # Между проверкой `while queue` и удалением нет await, новый апдейт не потеряется
+            del self._queues[key]
+
+    async def put(self, bot: Bot, update: dict, **data) -> bool:
+        """Ставит апдейт вебхука в очередь; False — очередь заполнена, ответить 503"""
+        if self._closing:
+            self.rejected += 1
+            return False
+        # Между получением апдейта и submit() нет await: апдейты встают в очередь в порядке получения
+        if self.dedup is not None and self.dedup.seen(update['update_id']):
+            # Повтор уже принятого апдейта: Telegram достаточно ответа 200, место в очереди не нужно
+            return True
+        if self._pending >= self.maxsize:
+            if self.dedup is not None:
+                # Апдейт не принят — повторная доставка не должна считаться дубликатом
+                self.dedup.forget(update['update_id'])
+            self.rejected += 1
+            return False
+        update = Update.model_validate(update, context={'bot': bot})
+        future = self.submit(update_key(update), lambda: self._process(bot, update, data))
+        future.add_done_callback(self._log_failure)
+        self.accepted += 1
+        return True
+
+    async def _process(self, bot: Bot, update: Update, data: dict):
+        # Проверка в общем Redis — уже по порядку очереди пользователя
+        if self.dedup is not None and await self.dedup.seen_shared(update.update_id):
+            logger.info(f"Повторный апдейт {update.update_id} пропущен")
+            return
+        result = await self.dispatcher.feed_update(bot, update, **data)
+        if isinstance(result, TelegramMethod):
+            await self.dispatcher.silent_call_request(bot=bot, result=result)
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Ошибка обработки апдейта: {future.exception()}")
+
+    async def __call__(self, handler, event: Update, data: dict):
+        # Для polling: регистрируется до FSM middleware, чтобы состояние
+        # читалось уже в порядке очереди пользователя
+        return await self.submit(update_key(event), lambda: handler(event, data))
+
+    def start(self):
+        self._closing = False
+
+    async def stop(self, timeout: float = UPDATE_DRAIN_TIMEOUT):
+        """Перестает принимать апдейты и ждет, пока очереди будут разобраны"""
+        self._closing = True
+        if self._drainers:
+            await asyncio.wait(set(self._drainers), timeout=timeout)
+        if self._pending:
+            logger.warning(f"Очередь не разобрана за {timeout} с, потеряно апдейтов: {self._pending}")
+        for task in list(self._drainers):
+            task.cancel()
+        await asyncio.gather(*self._drainers, return_exceptions=True)
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+
+        def percentile(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 1) if waits else 0.0
+
+        return {
+            'depth': self._pending,
+            'maxsize': self.maxsize,
+            'keys': len(self._queues),
+            'longest_key_queue': max((len(q) for q in self._queues.values()), default=0),
+            'workers': self.workers,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'wait_p50_ms': percentile(0.5),
+            'wait_p95_ms': percentile(0.95),
+            'wait_max_ms': round(self.wait_max * 1000, 1),
+        }
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """SimpleRequestHandler, который отдает апдейты в UpdateQueue"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, queue: UpdateQueue, **data):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self.queue = queue
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        if not await self.queue.put(bot, update, **self.data):
+            return web.json_response({'ok': False, 'description': 'Update queue is full'}, status=503,
+                                     headers={'Retry-After': str(UPDATE_RETRY_AFTER)})
+        return web.json_response({}, dumps=bot.session.json_dumps)